@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Batch atmospheric correction of many Sentinel-2 L1C products.
+
+Every product is processed by atmProcessingMain in its own process. The number
+of products processed at the same time is limited both by the number of
+processes and by the estimated memory use of each product.
+"""
+import os
+import glob
+import json
+import time
+import traceback
+import multiprocessing
+
+from atmProcessing import atmProcessingMain
+from processingPlan import planProcessing
+
+###############################################################################
+
+
+def atmBatchProcessingMain(jobs, processes=None, memoryLimit=None, reportFile=None):
+    # jobs is a list of atmProcessingMain options dictionaries, one per
+    # product. memoryLimit is in bytes, None means no limit.
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    report = []
+
+    def addStatus(status):
+        report.append(status)
+        if reportFile:
+            saveBatchReport(report, reportFile)
+
+    try:
+        from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+        from concurrent.futures.process import BrokenProcessPool
+    except ImportError:
+        # Python 2 without the futures backport: process the products one at
+        # a time in this process
+        for job in jobs:
+            addStatus(runBatchJob(job))
+        return report
+
+    # Products whose memory can not be estimated (missing metadata, unreadable
+    # DN file...) are reported as failed. Jobs flagged alone run without any
+    # other job.
+    waiting = []
+    for job in jobs:
+        try:
+            waiting.append((job, estimateJobMemory(job), False))
+        except Exception:
+            addStatus(failedJobStatus(job, traceback.format_exc()))
+    running = {}
+    executor = ProcessPoolExecutor(max_workers=processes)
+    try:
+        while waiting or running:
+            # Start as many jobs as the process and memory limits allow. One
+            # job is always allowed to run, even if it is over the limit.
+            while waiting and len(running) < processes:
+                job, jobMemory, alone = waiting[0]
+                usedMemory = sum(memory for _, memory, _ in running.values())
+                if running and (alone or any(a for _, _, a in running.values())):
+                    break
+                if (memoryLimit is not None and running and
+                        usedMemory + jobMemory > memoryLimit):
+                    break
+                waiting.pop(0)
+                running[executor.submit(runBatchJob, job)] = (job, jobMemory, alone)
+
+            done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            try:
+                for future in done:
+                    status = future.result()
+                    running.pop(future)
+                    addStatus(status)
+            except BrokenProcessPool:
+                # A worker process died, e.g. killed when out of memory, which
+                # fails all the running jobs. A job that was running alone is
+                # the one that died, the others are run again one at a time.
+                for future, (job, jobMemory, alone) in list(running.items()):
+                    if alone or len(running) == 1:
+                        addStatus(failedJobStatus(
+                            job, "The worker process processing the product died, "
+                            "possibly because it ran out of memory"))
+                    else:
+                        waiting.insert(0, (job, jobMemory, True))
+                running = {}
+                executor.shutdown(wait=False)
+                executor = ProcessPoolExecutor(max_workers=processes)
+    finally:
+        executor.shutdown(wait=True)
+
+    return report
+
+
+# Process one product and return its status. Runs in a worker process so all
+# errors are caught and reported instead of stopping the whole batch.
+def runBatchJob(options):
+    status = jobStatus(options)
+    startTime = time.time()
+    try:
+        reflectanceImg = atmProcessingMain(options)
+        reflectanceImg = None
+        status['status'] = 'ok'
+    except Exception:
+        status['status'] = 'failed'
+        status['error'] = traceback.format_exc()
+    status['seconds'] = time.time() - startTime
+    return status
+
+
+def jobStatus(options):
+    return {'metadataFile': options["metadataFile"],
+            'dnFile': options.get("dnFile"),
+            'reflectanceFile': options.get("reflectanceFile"),
+            'atmCorrMethod': options["atmCorrMethod"]}
+
+
+# Status of a product that failed outside of runBatchJob
+def failedJobStatus(options, error):
+    status = jobStatus(options)
+    status['status'] = 'failed'
+    status['error'] = error
+    status['seconds'] = 0.0
+    return status
+
+
+# Estimate of the peak memory, in bytes, used when processing one product,
+# see processingPlan
+def estimateJobMemory(options):
+    return planProcessing(options, options.get("memoryBudget"))['peakMemory']
+
+
+# Find all L1C products (MTD_MSIL1C.xml files) below inputDir and pair each
+# with the DN file <product name>.tif in dnDir. Products without a DN file, or
+# all products if dnDir is None, are read directly from their JP2 files.
+def findBatchJobs(inputDir, dnDir, outputDir, atmCorrMethod, workers=1):
+    metadataFiles = sorted(glob.glob(os.path.join(inputDir, "MTD_MSIL1C.xml")) +
+                           glob.glob(os.path.join(inputDir, "*", "MTD_MSIL1C.xml")))
+    jobs = []
+    for metadataFile in metadataFiles:
+        productName = os.path.split(os.path.dirname(os.path.abspath(metadataFile)))[1]
+        productName = os.path.splitext(productName)[0]
+        dnFile = None
+        if dnDir is not None and os.path.exists(os.path.join(dnDir, productName + ".tif")):
+            dnFile = os.path.join(dnDir, productName + ".tif")
+        jobs.append({"dnFile": dnFile,
+                     "metadataFile": metadataFile,
+                     "reflectanceFile": os.path.join(outputDir, productName + "_" +
+                                                     atmCorrMethod + ".tif"),
+                     "atmCorrMethod": atmCorrMethod,
+                     "workers": workers})
+    return jobs
+
+
+def saveBatchReport(report, reportFile):
+    with open(reportFile, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Atmospheric correction of all Sentinel-2 L1C products in a directory")
+    parser.add_argument("inputDir", help="directory containing the .SAFE products")
+    parser.add_argument("outputDir", help="directory where the results are saved")
+    parser.add_argument("--dn-dir", dest="dnDir", default=None,
+                        help="directory containing <product name>.tif DN files, by default "
+                        "the bands are read from the JP2 files of the products")
+    parser.add_argument("--method", default="DOS", choices=["DOS", "TOA", "RAD"])
+    parser.add_argument("--processes", type=int, default=None,
+                        help="maximum number of products processed at the same time")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of threads used for each product")
+    parser.add_argument("--dos-sample", dest="dosSampleFraction", type=float, default=None,
+                        help="estimate the DOS offsets from this fraction of the image blocks, "
+                        "at least 16 whole blocks, instead of reading the whole image")
+    parser.add_argument("--memory-limit", type=float, default=None,
+                        help="memory available to the batch in GB")
+    parser.add_argument("--report", default=None, help="JSON file with the status of each product")
+    args = parser.parse_args()
+
+    memoryLimit = None
+    if args.memory_limit is not None:
+        memoryLimit = int(args.memory_limit * 1024**3)
+    jobs = findBatchJobs(args.inputDir, args.dnDir, args.outputDir, args.method, args.workers)
+    for job in jobs:
+        job["dosSampleFraction"] = args.dosSampleFraction
+    report = atmBatchProcessingMain(jobs, args.processes, memoryLimit,
+                                    args.report or os.path.join(args.outputDir, "batch_report.json"))
+    failed = [status for status in report if status['status'] != 'ok']
+    print("%d products processed, %d failed" % (len(report), len(failed)))
@@ -30,12 +30,13 @@ __copyright__ = '(C) 2015 by DHI-GRAS'
 __revision__ = '$Format:%H$'
 
 from processing.core.GeoAlgorithm import GeoAlgorithm
+from processing.core.GeoAlgorithmExecutionException import GeoAlgorithmExecutionException
 from processing.core.outputs import OutputRaster
 from processing.core.parameters import ParameterSelection
 from processing.core.parameters import ParameterRaster
 from processing.core.parameters import ParameterFile
-
-from atmProcessing import atmProcessingMain, saveImgByCopy
+from processing.core.parameters import ParameterNumber
+from processing.core.parameters import ParameterBoolean
 
 
 class AtmosphericCorrectionAlgorithm(GeoAlgorithm):
@@ -44,6 +45,14 @@ class AtmosphericCorrectionAlgorithm(GeoAlgorithm):
     METAFILE = 'METAFILE'
     METHOD = 'METHOD'
     METHODS = ['DOS', 'TOA', 'RAD']
+    PER_PIXEL_SUN = 'PER_PIXEL_SUN'
+    WORKERS = 'WORKERS'
+    OUTPUT_ENCODING = 'OUTPUT_ENCODING'
+    OUTPUT_ENCODINGS = ['Float32', 'Float16', 'UInt16 (scaled)', 'Int16 (scaled)']
+    COG = 'COG'
+    USE_CACHE = 'USE_CACHE'
+    CACHE_DIR = 'CACHE_DIR'
+    CACHE_BUDGET = 'CACHE_BUDGET'
     OUTPUT_FILE = 'OUTPUT_FILE'
 
     def defineCharacteristics(self):
@@ -52,25 +61,71 @@ class AtmosphericCorrectionAlgorithm(GeoAlgorithm):
         # The branch of the toolbox under which the algorithm will appear
         self.group = 'Sentinel Tools'
 
-        self.addParameter(ParameterRaster(self.DN_FILE, 'DN file', showSublayersDialog=False))
+        self.addParameter(ParameterRaster(self.DN_FILE, 'DN file (read from the product if empty)',
+                                          optional=True, showSublayersDialog=False))
         self.addParameter(ParameterFile(self.METAFILE, 'Metafile', optional=False))
         self.addParameter(ParameterSelection(self.METHOD, 'Method', self.METHODS))
+        self.addParameter(ParameterBoolean(self.PER_PIXEL_SUN,
+                                           'Per-pixel sun zenith angle (RAD only)', False))
+        self.addParameter(ParameterNumber(self.WORKERS, 'Number of worker threads', 1, 64, 1))
+        self.addParameter(ParameterSelection(self.OUTPUT_ENCODING, 'Output data type',
+                                             self.OUTPUT_ENCODINGS))
+        self.addParameter(ParameterBoolean(self.COG,
+                                           'Save as Cloud-Optimized GeoTIFF with overviews', False))
+        self.addParameter(ParameterBoolean(self.USE_CACHE,
+                                           'Reuse the output of an identical earlier run', False))
+        self.addParameter(ParameterFile(self.CACHE_DIR,
+                                        'Result cache directory (~/.atmCorrection/results if '
+                                        'empty)', isFolder=True, optional=True))
+        self.addParameter(ParameterNumber(self.CACHE_BUDGET, 'Result cache size limit (GB)',
+                                          1, 10000, 20))
         self.addOutput(OutputRaster(self.OUTPUT_FILE, 'Output file'))
 
     def processAlgorithm(self, progress):
         """Here is where the processing itself takes place."""
+        # numpy and GDAL are only loaded when the algorithm is run
+        from atmProcessing import ProcessingCanceled
+        from resultCache import cachedAtmProcessingMain, resultCacheDir
+
         # The first thing to do is retrieve the values of the parameters
         # entered by the user
 
         methodList = ["DOS", "TOA", "RAD"]
+        encodingList = ["Float32", "Float16", "UInt16", "Int16"]
 
         options = {}
         # input/output parameters
         options["dnFile"] = self.getParameterValue(self.DN_FILE)
         options["metadataFile"] = self.getParameterValue(self.METAFILE)
         options["reflectanceFile"] = self.getOutputValue(self.OUTPUT_FILE)
+        options["outputEncoding"] = encodingList[self.getParameterValue(self.OUTPUT_ENCODING)]
+        options["outputProfile"] = "COG" if self.getParameterValue(self.COG) else "GTiff"
         # Atmospheric correction parameters
         options["atmCorrMethod"] = methodList[self.getParameterValue(self.METHOD)]
-
-        reflectanceImg = atmProcessingMain(options)
-        saveImgByCopy(reflectanceImg, options["reflectanceFile"])
+        options["perPixelSun"] = self.getParameterValue(self.PER_PIXEL_SUN)
+        # Native resolution processing saves one file per resolution instead
+        # of the output of the algorithm, it is only available in the command
+        # line and batch interfaces
+        options["nativeResolution"] = False
+        # Processing parameters
+        options["workers"] = int(self.getParameterValue(self.WORKERS))
+        # Report the progress after every processing window, and stop when
+        # the user cancels if the progress object supports it
+        options["progress"] = lambda percent: progress.setPercentage(int(percent))
+        options["isCanceled"] = getattr(progress, "isCanceled", None)
+        # Outputs of earlier runs with the same input and options are linked
+        # (or copied) from the result cache instead of being computed again
+        if self.getParameterValue(self.USE_CACHE):
+            options["resultCacheDir"] = self.getParameterValue(self.CACHE_DIR) or resultCacheDir
+            options["resultCacheBudget"] = int(float(self.getParameterValue(self.CACHE_BUDGET)) *
+                                               1024**3)
+            options["resultCacheLink"] = True
+
+        # The result is written straight to the output file, closing the
+        # dataset finishes the write
+        try:
+            reflectanceImg = cachedAtmProcessingMain(options)
+        except ProcessingCanceled:
+            raise GeoAlgorithmExecutionException("Atmospheric correction canceled, the "
+                                                 "partial output has been deleted")
+        reflectanceImg = None
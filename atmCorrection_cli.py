@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Command line interface for the Sentinel-2 atmospheric correction.
+
+Only needs numpy and GDAL, QGIS does not have to be installed. Usage:
+
+    python atmCorrection_cli.py METADATA_FILE OUTPUT_FILE --method DOS [--dn-file DN_FILE]
+"""
+import argparse
+import sys
+
+methodList = ["DOS", "TOA", "RAD"]
+encodingList = ["Float32", "Float16", "UInt16", "Int16"]
+kernelList = ["arithmetic", "lut"]
+
+
+def parseArguments(argv):
+    parser = argparse.ArgumentParser(
+        description="Sentinel-2 L1C atmospheric correction (DOS, TOA reflectance or radiance)")
+    parser.add_argument("metadataFile", help="MTD_MSIL1C.xml file of the product")
+    parser.add_argument("reflectanceFile", help="output GeoTIFF")
+    parser.add_argument("--dn-file", dest="dnFile", default=None,
+                        help="raster with the DN values of all bands, by default the bands "
+                        "are read from the JP2 files of the product")
+    parser.add_argument("--method", dest="atmCorrMethod", default="DOS", choices=methodList,
+                        help="correction method (default: DOS)")
+    parser.add_argument("--dos-sample", dest="dosSampleFraction", type=float, default=None,
+                        help="estimate the DOS offsets from this fraction (e.g. 0.1) of the "
+                        "image blocks, at least 16 whole blocks (1024 x 1024 pixels in the JP2 "
+                        "files), the whole image is read if the estimate is unstable")
+    parser.add_argument("--encoding", dest="outputEncoding", default="Float32",
+                        choices=encodingList,
+                        help="output data type, the integer types store scaled values "
+                        "(default: Float32)")
+    parser.add_argument("--cog", action="store_true",
+                        help="save as Cloud-Optimized GeoTIFF with overviews")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of threads used for processing (default: 1)")
+    parser.add_argument("--readers", type=int, default=1,
+                        help="number of threads reading the input ahead of the processing "
+                        "(default: 1)")
+    parser.add_argument("--native-resolution", dest="nativeResolution", action="store_true",
+                        help="process the 10, 20 and 60 m bands at their own resolution and "
+                        "save them in OUTPUT_FILE_10m.tif, OUTPUT_FILE_20m.tif and "
+                        "OUTPUT_FILE_60m.tif")
+    parser.add_argument("--per-pixel-sun", dest="perPixelSun", action="store_true",
+                        help="use the per-pixel instead of the mean sun zenith angle in RAD")
+    parser.add_argument("--preview", action="store_true",
+                        help="quick-look: process the bands read at reduced resolution and "
+                        "save the small result to OUTPUT_FILE")
+    parser.add_argument("--preview-size", dest="previewSize", type=int, default=1024,
+                        help="longest side of the preview in pixels (default: 1024)")
+    parser.add_argument("--kernel", default="arithmetic", choices=kernelList,
+                        help="compute the conversion for every pixel (arithmetic) or look it "
+                        "up in a table of all 16-bit DNs (lut) (default: arithmetic)")
+    parser.add_argument("--memory-budget", dest="memoryBudget", type=float, default=None,
+                        help="memory budget in GB, the window size, number of threads and "
+                        "GDAL cache size are chosen to stay under it")
+    parser.add_argument("--dry-run", dest="dryRun", action="store_true",
+                        help="print the processing plan with the predicted peak memory and "
+                        "bytes read and written, without processing anything")
+    parser.add_argument("--metrics", dest="metricsFile", default=None,
+                        help="save the time, bytes read/written and peak memory of every "
+                        "processing stage and band to this JSON file")
+    parser.add_argument("--profile", dest="profileFile", default=None,
+                        help="save cProfile statistics of the run to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArguments(argv)
+
+    # Import the processing only after the arguments are parsed, so that
+    # --help and argument errors do not have to wait for numpy and GDAL
+    from atmProcessing import atmProcessingMain, saveImgByCopy
+
+    options = {}
+    # input/output parameters
+    options["dnFile"] = args.dnFile
+    options["metadataFile"] = args.metadataFile
+    options["reflectanceFile"] = args.reflectanceFile
+    # Atmospheric correction parameters
+    options["atmCorrMethod"] = args.atmCorrMethod
+    options["perPixelSun"] = args.perPixelSun
+    options["dosSampleFraction"] = args.dosSampleFraction
+    options["nativeResolution"] = args.nativeResolution
+    options["outputEncoding"] = args.outputEncoding
+    options["outputProfile"] = "COG" if args.cog else "GTiff"
+    options["preview"] = args.preview
+    options["previewSize"] = args.previewSize
+    # Processing parameters
+    options["workers"] = args.workers
+    options["readers"] = args.readers
+    options["kernel"] = args.kernel
+    options["metricsFile"] = args.metricsFile
+    options["profileFile"] = args.profileFile
+    if args.memoryBudget is not None:
+        options["memoryBudget"] = int(args.memoryBudget * 1024**3)
+    options["dryRun"] = args.dryRun
+
+    if args.dryRun:
+        from processingPlan import formatPlan
+        print(formatPlan(atmProcessingMain(options)))
+        return 0
+
+    reflectanceImg = atmProcessingMain(options)
+    # Previews are returned in memory
+    if args.preview:
+        saveImgByCopy(reflectanceImg, args.reflectanceFile, args.outputEncoding)
+    reflectanceImg = None
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -33,14 +33,7 @@ import os
 import sys
 import inspect
 
-from processing.core.Processing import Processing
-from atmCorrection_provider import AtmosphericCorrectionProvider
 from PyQt4.QtCore import QSettings, QTranslator, qVersion, QCoreApplication
-from PyQt4.QtGui import QAction, QIcon
-# Initialize Qt resources from file resources.py
-import resources
-# Import the code for the dialog
-from atmospheric_correction_dialog import atmCorrectionDialog
 import os.path
 
 
@@ -71,20 +64,27 @@ class AtmosphericCorrectionPlugin:
             if qVersion() > '4.3.3':
                 QCoreApplication.installTranslator(self.translator)
 
-        # Create the dialog (after translation) and keep reference
-        self.dlg = atmCorrectionDialog()
+        # The dialog is created (after translation) the first time the plugin
+        # is run
+        self.dlg = None
 
         # get reference to the QGIS message bar
         self.msg_bar = self.iface.messageBar()
 
-        # Create the provider for Processing Toolbox
-        self.provider = AtmosphericCorrectionProvider()
+        # The provider for Processing Toolbox is created in initGui
+        self.provider = None
 
 
     def initGui(self):
         """
         Create action that will start plugin configuration
         """
+        from PyQt4.QtGui import QAction, QIcon
+        # Initialize Qt resources from file resources.py
+        import resources
+        from processing.core.Processing import Processing
+        from atmCorrection_provider import AtmosphericCorrectionProvider
+
         self.action = QAction(
             QIcon(":/plugins/atmCorrection/icon.png"),
             u"Atmospheric Correction", self.iface.mainWindow())
@@ -96,25 +96,38 @@ class AtmosphericCorrectionPlugin:
         self.iface.addPluginToVectorMenu(u"&Atmospheric Correction", self.action)
 
         # Add algorithms to Processing Toolbox
+        self.provider = AtmosphericCorrectionProvider()
         Processing.addProvider(self.provider)
 
     def unload(self):
         """
         Remove the plugin menu item and icon
         """
+        from processing.core.Processing import Processing
+
         self.iface.removePluginVectorMenu(u"&Atmospheric Correction", self.action)
         self.iface.removeToolBarIcon(self.action)
         Processing.removeProvider(self.provider)
         Processing.removeProvider(self.provider)
+        if self.dlg is not None:
+            # Stops a running correction and removes the preview layer
+            self.dlg.close()
+            self.dlg.removePreview()
+            self.dlg = None
 
     def run(self):
         """Run method that performs all the real work"""
-        # show the dialog
+        if self.dlg is None:
+            # Import the code for the dialog
+            from atmospheric_correction_dialog import atmCorrectionDialog
+            self.dlg = atmCorrectionDialog(self.iface.mainWindow())
+            self.dlg.accepted.connect(self.correctionFinished)
+        # show the dialog. It is not modal, so QGIS can be used while the
+        # correction runs.
         self.dlg.show()
-        # Run the dialog event loop
-        result = self.dlg.exec_()
-        # See if OK was pressed
-        if result:
-            # Do something useful here - delete the line containing pass and
-            # substitute with your code.
-            pass
\ No newline at end of file
+        self.dlg.raise_()
+        self.dlg.activateWindow()
+
+    def correctionFinished(self):
+        # The dialog is accepted when the output has been saved
+        self.msg_bar.pushInfo(u"Atmospheric Correction", u"The corrected image was saved")
@@ -7,230 +7,1313 @@ Created on Tue Sep 09 12:54:33 2014
 import numpy as np
 import os
 import glob
+import uuid
+import sys
+import time
+import tempfile
+import threading
+from collections import deque
+from contextlib import contextmanager
 from xml.etree import ElementTree as ET
 from math import cos, radians, pi
-from osgeo import gdal
+from osgeo import gdal, gdal_array
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from read_satellite_metadata import readMetadataS2L1C
+from processingMetrics import ProcessingMetrics, noMetrics, profiled
+from processingCore import dnRange, dosSampleBlockPixels, dosMinSampleBlocks, \
+    windowPixelsDefault, s2Bands, s2BandResolutions, reflectanceKernel, radianceKernel, \
+    lookupKernel, reflectanceTable, radianceTable, dnCounts, dosOffsets, windowStep, \
+    overviewFactors, halveWindow, cosSunZenithGrid, cosSunZenithWindow
 
 driverOptionsGTiff = ['COMPRESS=DEFLATE', 'PREDICTOR=1', 'BIGTIFF=IF_SAFER']
+# Used when the results are streamed straight into the output file, so that
+# each window only touches a few compressed tiles
+driverOptionsGTiffTiled = driverOptionsGTiff + ['TILED=YES', 'INTERLEAVE=BAND']
+# Cloud-Optimized GeoTIFF outputs
+driverOptionsCOG = ['COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER']
+# Number of buckets of the histograms saved with the outputs
+histogramBuckets = 256
+# Default size of the longest side of preview images in pixels
+previewSizeDefault = 1024
+# Output data types. The integer types store scaled values, with the scale
+# written to the band metadata. Float16 is stored as 16 bit floating point
+# in GeoTIFF files.
+outputEncodings = {'Float32': (gdal.GDT_Float32, []),
+                   'Float16': (gdal.GDT_Float32, ['NBITS=16']),
+                   'UInt16': (gdal.GDT_UInt16, []),
+                   'Int16': (gdal.GDT_Int16, [])}
+# Smallest value, largest value and no-data value of the integer types
+integerEncodingRanges = {gdal.GDT_UInt16: (0, 65534, 65535),
+                         gdal.GDT_Int16: (-32767, 32767, -32768)}
+# Integer value of 1 unit of reflectance or radiance (W/m2/sr/um). The
+# radiance step of 0.025 is finer than one L1C DN, and Int16 still holds
+# radiances up to 819.
+reflectanceScale = 10000
+radianceScale = 40
+# Ways of converting the DNs of a window: "arithmetic" computes the formula
+# for every pixel, "lut" looks the value of every DN up in a 65536 entry table
+# per band (only for 8 and 16 bit DN inputs, others always use arithmetic).
+# Which one is faster depends on the numpy version and CPU, see
+# benchmarks/benchmark.py --kernels.
+conversionKernels = ["arithmetic", "lut"]
 ###############################################################################
 
 
+# Raised when the processing is canceled through the isCanceled option
+class ProcessingCanceled(Exception):
+    pass
+
+
+# Reports the progress of the processing, in percent, to the progress
+# callback and checks the isCanceled callback at window boundaries. The
+# passes over the image (DOS histograms, conversion, COG copy) each cover a
+# part of the range of the caller, set with part().
+class ProcessingFeedback(object):
+
+    def __init__(self, progress=None, isCanceled=None):
+        self.progress = progress
+        self.isCanceled = isCanceled
+        self.start = 0.0
+        self.end = 100.0
+
+    # Map the 0-100 progress of the body of a with statement to start-end of
+    # the current range
+    @contextmanager
+    def part(self, start, end):
+        outer = self.start, self.end
+        span = (self.end - self.start) / 100.0
+        self.start, self.end = outer[0] + start * span, outer[0] + end * span
+        try:
+            yield
+        finally:
+            self.start, self.end = outer
+
+    def checkCanceled(self):
+        if self.isCanceled is not None and self.isCanceled():
+            raise ProcessingCanceled()
+
+    def windowDone(self, done, total):
+        self.checkCanceled()
+        if self.progress is not None:
+            self.progress(self.start + (self.end - self.start) * done / float(total))
+
+    # Progress callback for GDAL functions, which stop when it returns 0
+    def gdalCallback(self, complete, message=None, data=None):
+        if self.isCanceled is not None and self.isCanceled():
+            return 0
+        if self.progress is not None:
+            self.progress(self.start + (self.end - self.start) * complete)
+        return 1
+
+
+noFeedback = ProcessingFeedback()
+
+
 def atmProcessingMain(options):
 
-    # Commonly used filenames
-    dnFile = options["dnFile"]
+    # Per-stage timing and memory measurements, see processingMetrics. Pass a
+    # ProcessingMetrics object in "metrics" to get them back, or give
+    # "metricsFile" to save them as JSON.
+    metricsFile = options.get("metricsFile")
+    metrics = options.get("metrics")
+    if metrics is None:
+        metrics = ProcessingMetrics() if metricsFile else noMetrics
+    # Save cProfile statistics of the run to this file
+    profileFile = options.get("profileFile")
+    # "progress" is called with the percentage done after every processing
+    # window. When "isCanceled" returns True the processing stops at the next
+    # window, partial outputs are deleted and ProcessingCanceled is raised.
+    feedback = ProcessingFeedback(options.get("progress"), options.get("isCanceled"))
+
+    # Choose the window size, the number of threads and the GDAL cache size
+    # to stay under "memoryBudget" bytes, see processingPlan. With "dryRun"
+    # the plan, with the predicted peak memory and bytes read and written, is
+    # returned without processing anything.
+    gdalCacheMax = None
+    if options.get("memoryBudget") or options.get("dryRun", False):
+        from processingPlan import planProcessing
+        plan = planProcessing(options, options.get("memoryBudget"))
+        if options.get("dryRun", False):
+            return plan
+        options = dict(options)
+        options.update(workers=plan['workers'], readers=plan['readers'],
+                       windowPixels=plan['windowPixels'])
+        gdalCacheMax = gdal.GetCacheMax()
+        gdal.SetCacheMax(plan['gdalCacheMax'])
+
+    try:
+        with profiled(profileFile), metrics.stage("total"):
+            return _atmProcessingMain(options, metrics, feedback)
+    finally:
+        if metricsFile:
+            metrics.save(metricsFile)
+        if gdalCacheMax is not None:
+            gdal.SetCacheMax(gdalCacheMax)
+
+
+def _atmProcessingMain(options, metrics, feedback):
+
+    # Commonly used filenames. Without a DN file the bands are read straight
+    # from the JP2 files of the product.
+    dnFile = options.get("dnFile")
     metadataFile = options["metadataFile"]
+    # Write directly to this file when given, otherwise keep result in memory
+    outPath = options.get("reflectanceFile") or "MEM"
 
-    # Correction options
-    atmCorrMethod = options["atmCorrMethod"]
+    # Process the bands of the product at their own resolution and save one
+    # output per resolution (<reflectanceFile>_10m.tif etc.)
+    nativeResolution = options.get("nativeResolution", False)
+
+    # Read metadata in to a record
+    with metrics.stage("metadata"):
+        metadataFile = readMetadataS2L1C(metadataFile)
 
-    # Read metadata in to dictionary
-    metadataFile = readMetadataS2L1C(metadataFile)
+    # Quick-look: process the bands read at reduced resolution and return the
+    # result in memory
+    if options.get("preview", False):
+        return _atmProcessingPreview(dnFile, metadataFile, options, metrics, feedback)
 
-    # Get reflectance or radiance
-    if atmCorrMethod in ["DOS", "TOA"]:
-        if atmCorrMethod == "DOS":
-            doDOS = True
+    if nativeResolution:
+        if dnFile:
+            raise ValueError("Native resolution processing reads the bands from the "
+                             "product, a DN file can not be used")
+        # Dictionary of the output images by resolution
+        reflectanceImg = {}
+        # Share of the progress of each resolution, by number of pixels
+        pixels = dict((resolution, len(s2BandResolutions[resolution]) * 100.0 / resolution**2)
+                      for resolution in s2BandResolutions)
+        done = 0.0
+        try:
+            for resolution in sorted(s2BandResolutions):
+                share = 100.0 * pixels[resolution] / sum(pixels.values())
+                with metrics.section("%dm" % resolution), feedback.part(done, done + share):
+                    reflectanceImg[resolution] = _atmProcessingSafe(
+                        metadataFile, s2BandResolutions[resolution],
+                        resolutionFileName(outPath, resolution), options, metrics,
+                        feedback)
+                    if outPath != "MEM":
+                        with metrics.stage("flush"):
+                            reflectanceImg[resolution].FlushCache()
+                done += share
+        except ProcessingCanceled:
+            # Also remove the resolutions that were already finished
+            for resolution in list(reflectanceImg):
+                reflectanceImg[resolution] = None
+                deleteOutput(resolutionFileName(outPath, resolution))
+            raise
+        return reflectanceImg
+
+    if dnFile:
+        reflectanceImg = _atmProcessing(dnFile, metadataFile, outPath, options, metrics,
+                                        feedback)
+    else:
+        bandIds = list(range(len(metadataFile.irradiance_values)))
+        reflectanceImg = _atmProcessingSafe(metadataFile, bandIds, outPath, options,
+                                            metrics, feedback)
+
+    if outPath != "MEM":
+        with metrics.stage("flush"):
+            reflectanceImg.FlushCache()
+
+    return reflectanceImg
+
+
+# Process the given bands straight from the JP2 files of the product
+def _atmProcessingSafe(metadataFile, bandIds, outPath, options, metrics=noMetrics,
+                       feedback=noFeedback):
+    vrtFile = "/vsimem/%s_%s.vrt" % (metadataFile.product_name, uuid.uuid4().hex)
+    with metrics.stage("vrt"):
+        buildSafeVrt(metadataFile, vrtFile, bandIds)
+    try:
+        return _atmProcessing(vrtFile, metadataFile, outPath, options, metrics, feedback,
+                              bandIds)
+    finally:
+        gdal.Unlink(vrtFile)
+
+
+# Process a decimated copy of the DN file or of the bands of the product, at
+# most options["previewSize"] pixels on the longest side. The DOS offsets are
+# estimated from the decimated data.
+def _atmProcessingPreview(dnFile, metadataFile, options, metrics=noMetrics,
+                          feedback=noFeedback):
+    previewSize = int(options.get("previewSize", previewSizeDefault))
+    uid = uuid.uuid4().hex
+    previewFile = "/vsimem/%s_%s_preview.tif" % (metadataFile.product_name, uid)
+    vrtFile = None
+    bandIds = None
+    try:
+        if dnFile:
+            inImg = gdal.Open(dnFile)
         else:
-            doDOS = False
-        inImg = gdal.Open(dnFile)
-        reflectanceImg = toaReflectanceS2(inImg, metadataFile, doDOS=doDOS)
+            vrtFile = "/vsimem/%s_%s.vrt" % (metadataFile.product_name, uid)
+            bandIds = list(range(len(metadataFile.irradiance_values)))
+            with metrics.stage("vrt"):
+                buildSafeVrt(metadataFile, vrtFile, bandIds)
+            inImg = gdal.Open(vrtFile)
+        with metrics.stage("previewRead"), feedback.part(0, 50):
+            decimateImg(inImg, previewFile, previewSize, feedback)
+        inImg = None
+        with feedback.part(50, 100):
+            return _atmProcessing(previewFile, metadataFile, "MEM", options, metrics,
+                                  feedback, bandIds)
+    finally:
         inImg = None
+        gdal.Unlink(previewFile)
+        if vrtFile is not None:
+            gdal.Unlink(vrtFile)
+
+
+# Copy inImg to an uncompressed GeoTIFF (which can be in /vsimem/) with at
+# most maxSize pixels on the longest side. The bands are read with decimated
+# (buf_xsize/buf_ysize) reads, for which GDAL uses the overviews of the input
+# and JPEG2000 files decode only the needed resolution levels.
+def decimateImg(inImg, outFile, maxSize, feedback=noFeedback):
+    cols, rows = inImg.RasterXSize, inImg.RasterYSize
+    factor = max(float(max(cols, rows)) / maxSize, 1.0)
+    outCols, outRows = max(int(round(cols / factor)), 1), max(int(round(rows / factor)), 1)
+    geotransform = list(inImg.GetGeoTransform())
+    geotransform[1] *= float(cols) / outCols
+    geotransform[2] *= float(rows) / outRows
+    geotransform[4] *= float(cols) / outCols
+    geotransform[5] *= float(rows) / outRows
+
+    dataType = inImg.GetRasterBand(1).DataType
+    outImg = gdal.GetDriverByName("GTiff").Create(outFile, outCols, outRows,
+                                                  inImg.RasterCount, dataType)
+    outImg.SetProjection(inImg.GetProjection())
+    outImg.SetGeoTransform(geotransform)
+    for i in range(inImg.RasterCount):
+        data = inImg.GetRasterBand(i+1).ReadAsArray(0, 0, cols, rows, buf_xsize=outCols,
+                                                    buf_ysize=outRows)
+        outImg.GetRasterBand(i+1).WriteArray(data)
+        feedback.windowDone(i + 1, inImg.RasterCount)
+    outImg = None
+    return outFile
+
+
+# Name of the output of one resolution in native resolution processing
+def resolutionFileName(outPath, resolution):
+    if outPath == "MEM":
+        return outPath
+    base, ext = os.path.splitext(outPath)
+    return "%s_%dm%s" % (base, resolution, ext or ".tif")
+
 
-    elif atmCorrMethod == "RAD":
-        doDOS = False
-        inImg = gdal.Open(dnFile)
-        radianceImg = toaRadianceS2(inImg, metadataFile)
-        reflectanceImg = radianceImg
+def _atmProcessing(dnFile, metadataFile, outPath, options, metrics=noMetrics,
+                   feedback=noFeedback, bandIds=None):
+
+    # Correction options
+    atmCorrMethod = options["atmCorrMethod"]
+    # Use the per-pixel sun zenith angle instead of the scene mean in RAD
+    perPixelSun = options.get("perPixelSun", False)
+    # Number of threads used to process the image windows
+    workers = int(options.get("workers", 1))
+    # Estimate the DOS offsets from this fraction of the image blocks instead
+    # of the whole image. If the estimated deviation from the exact offsets
+    # is more than dosTolerance DN in any band, the whole image is used.
+    dosSampleFraction = options.get("dosSampleFraction")
+    dosTolerance = float(options.get("dosTolerance", 1.0))
+    # Number of threads reading the input windows ahead of the processing
+    readers = int(options.get("readers", 1))
+    # Approximate number of pixels per band in one processing window
+    windowPixels = int(options.get("windowPixels", windowPixelsDefault))
+    # How the DNs are converted, one of conversionKernels
+    kernel = options.get("kernel", "arithmetic")
+    # Data type of the output, one of outputEncodings
+    encoding = options.get("outputEncoding", "Float32")
+    # Keep results in memory (no output file) in a memory-mapped scratch file
+    # in this directory, so that the operating system can page them out to
+    # local disk instead of swapping
+    scratchDir = options.get("scratchDir")
+    # Save as a Cloud-Optimized GeoTIFF. The result and its overviews are
+    # first written to a temporary tiled GeoTIFF and then copied to the COG
+    # layout, which needs the overviews before the full resolution data.
+    cog = options.get("outputProfile", "GTiff") == "COG" and outPath != "MEM"
+    finalPath = outPath
+    if cog:
+        outPath = os.path.splitext(finalPath)[0] + "_tmp.tif"
+
+    try:
+        # Get reflectance or radiance. The COG copy takes the last 10 % of
+        # the progress.
+        with feedback.part(0, 90 if cog else 100):
+            if atmCorrMethod in ["DOS", "TOA"]:
+                if atmCorrMethod == "DOS":
+                    doDOS = True
+                else:
+                    doDOS = False
+                inImg = gdal.Open(dnFile)
+                reflectanceImg = toaReflectanceS2(inImg, metadataFile, doDOS=doDOS,
+                                                  outPath=outPath, workers=workers,
+                                                  encoding=encoding, overviews=cog,
+                                                  metrics=metrics, feedback=feedback,
+                                                  kernel=kernel, readers=readers,
+                                                  dosSampleFraction=dosSampleFraction,
+                                                  dosTolerance=dosTolerance,
+                                                  windowPixels=windowPixels,
+                                                  scratchDir=scratchDir)
+                inImg = None
+
+            elif atmCorrMethod == "RAD":
+                doDOS = False
+                inImg = gdal.Open(dnFile)
+                radianceImg = toaRadianceS2(inImg, metadataFile, outPath=outPath,
+                                            workers=workers, perPixelSun=perPixelSun,
+                                            bandIds=bandIds, encoding=encoding,
+                                            overviews=cog, metrics=metrics, feedback=feedback,
+                                            kernel=kernel, readers=readers,
+                                            windowPixels=windowPixels, scratchDir=scratchDir)
+                inImg = None
+                reflectanceImg = radianceImg
+
+        if cog:
+            start = time.time()
+            try:
+                with feedback.part(90, 100):
+                    reflectanceImg = saveCog(reflectanceImg, finalPath, encoding,
+                                             callback=feedback.gdalCallback)
+            except RuntimeError:
+                # GDAL raises when exceptions are enabled and the copy is
+                # stopped by the callback
+                feedback.checkCanceled()
+                raise
+            feedback.checkCanceled()
+            if reflectanceImg is None:
+                raise RuntimeError("Could not save %s" % finalPath)
+            metrics.add("cogCopy", seconds=time.time() - start,
+                        bytesWritten=os.path.getsize(finalPath))
+    except ProcessingCanceled:
+        # Close and delete the partial output
+        inImg = reflectanceImg = radianceImg = None
+        deleteOutput(outPath)
+        deleteOutput(finalPath)
+        raise
+    except Exception:
+        # Never leave the temporary GeoTIFF of the COG copy next to the output
+        if cog:
+            inImg = reflectanceImg = radianceImg = None
+            deleteOutput(outPath)
+        raise
 
     return reflectanceImg
 
+
+# Delete a partially written output file
+def deleteOutput(outPath):
+    if outPath != "MEM" and os.path.exists(outPath):
+        gdal.GetDriverByName("GTiff").Delete(outPath)
+
+
+# Stack the JP2 files of the bands with the given bandIds (all by default) in
+# the granule IMG_DATA directory into a virtual raster, so they can be
+# processed without first writing a multi-band DN file. Bands with a lower
+# resolution than the finest one are resampled (nearest neighbour) on the
+# fly. Returns vrtFile, which can be a /vsimem/ path.
+def buildSafeVrt(metadataFile, vrtFile, bandIds=None):
+    gdal.FileFromMemBuffer(vrtFile, safeVrtXml(metadataFile, bandIds))
+    return vrtFile
+
+
+# The XML of the virtual raster of buildSafeVrt, which GDAL can also open
+# directly as a dataset name
+def safeVrtXml(metadataFile, bandIds=None):
+    if bandIds is None:
+        bandIds = range(len(metadataFile.irradiance_values))
+    imgDataDir = os.path.join(os.path.dirname(metadataFile.tile_metadata_file), "IMG_DATA")
+    bandFiles = []
+    for band in [s2Bands[bandId] for bandId in bandIds]:
+        files = glob.glob(os.path.join(imgDataDir, "*_" + band + ".jp2"))
+        if not files:
+            raise IOError("No JP2 file for band %s in %s" % (band, imgDataDir))
+        bandFiles.append(files[0])
+
+    vrtFile = "/vsimem/%s_%s.vrt" % (metadataFile.product_name, uuid.uuid4().hex)
+    vrt = gdal.BuildVRT(vrtFile, bandFiles, separate=True, resolution="highest")
+    vrtXml = vrt.GetMetadata("xml:VRT")[0]
+    vrt = None
+    gdal.Unlink(vrtFile)
+
+    # Give the virtual bands the block size of the finest resolution JP2
+    # files, which the processing windows follow. The VRT default of 128 x 128
+    # would decode every JP2 block many times.
+    finestCols = 0
+    for bandFile in bandFiles:
+        jp2Img = gdal.Open(bandFile)
+        if jp2Img.RasterXSize > finestCols:
+            finestCols = jp2Img.RasterXSize
+            blockX, blockY = jp2Img.GetRasterBand(1).GetBlockSize()
+        jp2Img = None
+    vrtTree = ET.fromstring(vrtXml)
+    for bandNode in vrtTree.findall("VRTRasterBand"):
+        bandNode.set("blockXSize", str(blockX))
+        bandNode.set("blockYSize", str(blockY))
+    return ET.tostring(vrtTree).decode("utf-8")
+
 ################################################################################################
 
 
+# Band numbers of the visible and NIR bands of bandIds (the product band of
+# each band of the image), the only bands converted to radiance, and the
+# factor converting their DNs to radiance. The factor includes the mean sun
+# zenith angle unless perPixelSun, then the radiance is multiplied by the
+# cosine of the angle of each pixel.
+def radianceScales(metadataFile, bandIds, perPixelSun=False):
+    qv = metadataFile.quantification_value
+    bands = [i+1 for i in range(len(bandIds)) if bandIds[i] < 9]
+    e0 = [metadataFile.irradiance_values[bandIds[band-1]] for band in bands]
+    # Combine all the per-band constants into one factor
+    if perPixelSun:
+        scale = [e0[i] / (qv * pi) for i in range(len(bands))]
+    else:
+        z = metadataFile.sun_zenit
+        scale = [(e0[i] * cos(radians(z))) / (qv * pi) for i in range(len(bands))]
+    return bands, scale
+
+
+# DOS offsets of the bands of inImg. With sampleFraction they are estimated
+# from a sample of the image blocks, unless there are too few blocks or the
+# estimated deviation is more than tolerance DN in any band, otherwise they
+# are computed from the DN histograms of the whole image. Returns the
+# offsets, their estimated deviations (None when exact) and the DN
+# histograms (None when estimated).
+def dosOffsetsFor(inImg, sampleFraction=None, tolerance=1.0, workers=1,
+                  windowPixels=windowPixelsDefault, metrics=noMetrics, feedback=noFeedback):
+    if sampleFraction:
+        with metrics.stage("dosSample"), feedback.part(0, 10):
+            dosDN, dosDeviation = approximateDarkObjectSubstraction(
+                inImg, sampleFraction, workers=workers, feedback=feedback)
+        if dosDN is not None and max(dosDeviation) <= tolerance:
+            return dosDN, dosDeviation, None
+    with metrics.stage("dosHistogram", bytesRead=imageBytes(inImg)), feedback.part(0, 30):
+        hist = dnHistograms(inImg, workers=workers, feedback=feedback,
+                            windowPixels=windowPixels)
+    return darkObjectSubstraction(inImg, hist=hist), None, hist
+
+
 # Method taken from the bottom of http://s2tbx.telespazio-vega.de/sen2three/html/r2rusage.html
 # Assumes a L1C product which contains TOA reflectance: https://sentinel.esa.int/web/sentinel/user-guides/sentinel-2-msi/product-types
-def toaRadianceS2(inImg, metadataFile):
-    qv = float(metadataFile['quantification_value'])
-    e0 = []
-    for e in metadataFile['irradiance_values']:
-        e0.append(float(e))
-    z = float(metadataFile['sun_zenit'])
-
-    visNirBands = range(1, 10)
-    # Convert to radiance
-    radiometricData = np.zeros((inImg.RasterYSize, inImg.RasterXSize, len(visNirBands)))
-    for i in range(len(visNirBands)):
-        rToa = (inImg.GetRasterBand(i+1).ReadAsArray().astype(float)) / qv
-        radiometricData[:, :, i] = (rToa * e0[i] * cos(radians(z))) / pi
-    res = saveImg(radiometricData, inImg.GetGeoTransform(), inImg.GetProjection(), "MEM")
+# With perPixelSun the sun zenith angle is interpolated from the 5 km grid in
+# MTD_TL.xml for every pixel, otherwise the scene mean is used. bandIds gives
+# the metadata bandId of each band of inImg, by default the bands are assumed
+# to be in product order. Only the visible and NIR bands are converted.
+def toaRadianceS2(inImg, metadataFile, outPath="MEM", workers=1, perPixelSun=False,
+                  bandIds=None, encoding="Float32", overviews=False, metrics=noMetrics,
+                  feedback=noFeedback, kernel="arithmetic", readers=1,
+                  windowPixels=windowPixelsDefault, scratchDir=None):
+    if bandIds is None:
+        bandIds = range(inImg.RasterCount)
+    visNirBands, scale = radianceScales(metadataFile, bandIds, perPixelSun)
+    if perPixelSun:
+        cosZenithGrid = cosSunZenithGrid(metadataFile)
+        geotransform = inImg.GetGeoTransform()
+
+    # Without per-pixel sun angles the radiance is a function of the DN only,
+    # so the output statistics can be computed from DN histograms
+    countDN = hasDNType(inImg) and not perPixelSun
+    stats = [None] * len(visNirBands)
+    # Radiance (without the per-pixel sun angle) of every DN of each band
+    if hasDNType(inImg):
+        tables = [radianceTable(scale[i]) for i in range(len(visNirBands))]
+        # The per-pixel radiance is at most that of the largest DN, and of
+        # what an integer encoding stores
+        high = histogramRange(radianceScale, encoding)[1]
+        if outputEncodings[encoding][0] not in integerEncodingRanges:
+            high = np.inf
+        histRanges = [(0.0, float(min(tables[i][-1], high)))
+                      for i in range(len(visNirBands))]
+    else:
+        histRanges = [histogramRange(radianceScale, encoding)] * len(visNirBands)
+    useTables = kernel == "lut" and hasDNType(inImg)
+
+    def readWindow(ds, window, rawData):
+        return readBands(ds, visNirBands, window, metrics, rawData)
+
+    def convertWindow(window, rawData, radiometricData):
+        if perPixelSun:
+            cosZenith = cosSunZenithWindow(cosZenithGrid, geotransform, window)
+        statsParts = []
+        for i in range(len(visNirBands)):
+            start = time.time()
+            if useTables:
+                lookupKernel(rawData[i], tables[i], radiometricData[i])
+            else:
+                radianceKernel(rawData[i], scale[i], radiometricData[i])
+            if perPixelSun:
+                radiometricData[i] *= cosZenith
+            statsParts.append(statisticsPart(rawData[i], radiometricData[i], countDN,
+                                             histRanges[i], halfFloat))
+            metrics.add("compute", i+1, time.time() - start)
+        return radiometricData, statsParts
+
+    def saveWindow(window, result):
+        radiometricData, statsParts = result
+        writeWindow(res, window, radiometricData, metrics)
+        for i in range(len(visNirBands)):
+            stats[i] = addStatisticsPart(stats[i], statsParts[i])
+
+    # Convert to radiance, one window at a time
+    res = createImg(inImg.RasterXSize, inImg.RasterYSize, len(visNirBands),
+                    inImg.GetGeoTransform(), inImg.GetProjection(), outPath,
+                    encoding=encoding, scale=radianceScale, overviews=overviews,
+                    scratchDir=scratchDir)
+    halfFloat = isHalfFloat(res.GetRasterBand(1))
+    try:
+        pipelineWindows(inImg, readWindow, convertWindow, saveWindow, len(visNirBands),
+                        res, readers, workers, feedback, windowPixels, rawType(inImg))
+    except Exception:
+        # Close the output so that it can be deleted
+        res = None
+        raise
+
+    # Save the statistics and histograms of the bands
+    with metrics.stage("statistics"):
+        for i in range(len(visNirBands)):
+            if countDN:
+                setStatisticsFromDN(res.GetRasterBand(i+1), stats[i], tables[i])
+            else:
+                setStatistics(res.GetRasterBand(i+1), stats[i], histRanges[i])
     return res
 
 
 # Assumes a L1C product which contains TOA reflectance: https://sentinel.esa.int/web/sentinel/user-guides/sentinel-2-msi/product-types
-def toaReflectanceS2(inImg, metadataFile, doDOS=False):
-    qv = float(metadataFile['quantification_value'])
+def toaReflectanceS2(inImg, metadataFile, doDOS=False, outPath="MEM", workers=1,
+                     encoding="Float32", overviews=False, metrics=noMetrics,
+                     feedback=noFeedback, kernel="arithmetic", readers=1,
+                     dosSampleFraction=None, dosTolerance=1.0,
+                     windowPixels=windowPixelsDefault, scratchDir=None):
+    qv = metadataFile.quantification_value
+
+    # The reflectance is a function of the DN, so the output statistics are
+    # computed from DN histograms. With DOS these are already counted.
+    countDN = hasDNType(inImg)
+    stats = [None] * inImg.RasterCount
 
     # perform dark object substraction
+    dosDeviation = None
+    exactDOS = False
     if doDOS:
-        dosDN = darkObjectSubstraction(inImg)
+        dosDN, dosDeviation, hist = dosOffsetsFor(inImg, dosSampleFraction, dosTolerance,
+                                                  workers, windowPixels, metrics, feedback)
+        exactDOS = hist is not None
+        if exactDOS and countDN:
+            stats = list(hist)
     else:
-        dosDN = list(np.zeros((inImg.RasterYSize, inImg.RasterXSize)))
+        dosDN = [0] * inImg.RasterCount
 
-    # Convert to TOA reflectance
-    rToa = np.zeros((inImg.RasterYSize, inImg.RasterXSize, inImg.RasterCount))
-    for i in range(inImg.RasterCount):
-        rawData = inImg.GetRasterBand(i+1).ReadAsArray().astype(float)
-        rToa[:, :, i] = np.where((rawData-dosDN[i]) > 0,
-                                 (rawData-dosDN[i]) / qv,
-                                 0)
+    countWindows = not (exactDOS and countDN)
+    histRange = histogramRange(reflectanceScale, encoding)
+    # Reflectance of every DN of each band
+    if countDN:
+        tables = [reflectanceTable(dosDN[i], qv) for i in range(inImg.RasterCount)]
+    useTables = kernel == "lut" and countDN
+
+    bands = list(range(1, inImg.RasterCount + 1))
+
+    def readWindow(ds, window, rawData):
+        return readBands(ds, bands, window, metrics, rawData)
+
+    def convertWindow(window, rawData, rToa):
+        statsParts = []
+        for i in range(len(bands)):
+            start = time.time()
+            if useTables:
+                lookupKernel(rawData[i], tables[i], rToa[i])
+            else:
+                reflectanceKernel(rawData[i], dosDN[i], qv, rToa[i])
+            if countWindows:
+                statsParts.append(statisticsPart(rawData[i], rToa[i], countDN, histRange,
+                                                 halfFloat))
+            metrics.add("compute", i+1, time.time() - start)
+        return rToa, statsParts
+
+    def saveWindow(window, result):
+        rToa, statsParts = result
+        writeWindow(res, window, rToa, metrics)
+        for i in range(len(statsParts)):
+            stats[i] = addStatisticsPart(stats[i], statsParts[i])
+
+    # Convert to TOA reflectance, one window at a time
+    res = createImg(inImg.RasterXSize, inImg.RasterYSize, inImg.RasterCount,
+                    inImg.GetGeoTransform(), inImg.GetProjection(), outPath,
+                    encoding=encoding, scale=reflectanceScale, overviews=overviews,
+                    scratchDir=scratchDir)
+    halfFloat = isHalfFloat(res.GetRasterBand(1))
+    # Record the DOS offsets, and their estimated deviation from the exact
+    # offsets when they were estimated from a sample
+    if doDOS:
+        for i in range(inImg.RasterCount):
+            band = res.GetRasterBand(i+1)
+            band.SetMetadataItem("DOS_OFFSET", str(dosDN[i]))
+            if dosDeviation is not None:
+                band.SetMetadataItem("DOS_OFFSET_DEVIATION", "%.3f" % dosDeviation[i])
+    try:
+        with feedback.part((30 if exactDOS else 10) if doDOS else 0, 100):
+            pipelineWindows(inImg, readWindow, convertWindow, saveWindow, len(bands),
+                            res, readers, workers, feedback, windowPixels, rawType(inImg))
+    except Exception:
+        # Close the output so that it can be deleted
+        res = None
+        raise
+
+    # Save the statistics and histograms of the bands
+    with metrics.stage("statistics"):
+        for i in range(inImg.RasterCount):
+            if countDN:
+                setStatisticsFromDN(res.GetRasterBand(i+1), stats[i], tables[i])
+            else:
+                setStatistics(res.GetRasterBand(i+1), stats[i], histRange)
 
-    res = saveImg(rToa, inImg.GetGeoTransform(), inImg.GetProjection(), "MEM")
     return res
 
 
-def darkObjectSubstraction(inImg):
-    dosDN = []
-    tempData = inImg.GetRasterBand(1).ReadAsArray()
-    numElements = np.size(tempData[tempData != 0])
-    tempData = None
-    for band in range(1, inImg.RasterCount+1):
-        hist, edges = np.histogram(inImg.GetRasterBand(band).ReadAsArray(), bins=2048,
-                                   range=(1, 2048), density=False)
-        for i in range(1, len(hist)):
-            if hist[i] - hist[i-1] > (numElements-numElements*0.999999):
-                dosDN.append(i-1)
-                break
-    return dosDN
-
-
-def readMetadataS2L1C(metadataFile):
-    # Get parameters from main metadata file
-    ProductName = os.path.split(os.path.dirname(metadataFile))[1]
-    tree = ET.parse(metadataFile)
-    root = tree.getroot()
-    namespace = root.tag.split('}')[0]+'}'
-
-    baseNodePath = "./"+namespace+"General_Info/Product_Info/"
-    dateTimeStr = root.find(baseNodePath+"PRODUCT_START_TIME").text
-    procesLevel = root.find(baseNodePath+"PROCESSING_LEVEL").text
-    spaceCraft = root.find(baseNodePath+"Datatake/SPACECRAFT_NAME").text
-    orbitDirection = root.find(baseNodePath+"Datatake/SENSING_ORBIT_DIRECTION").text
-
-    baseNodePath = "./"+namespace+"General_Info/Product_Image_Characteristics/"
-    quantificationVal = root.find(baseNodePath+"QUANTIFICATION_VALUE").text
-    reflectConversion = root.find(baseNodePath+"Reflectance_Conversion/U").text
-    irradianceNodes = root.findall(baseNodePath+"Reflectance_Conversion/Solar_Irradiance_List/SOLAR_IRRADIANCE")
-    e0 = []
-    for node in irradianceNodes:
-        e0.append(node.text)
-
-    # save to dictionary
-    metaDict = {}
-    metaDict.update({'product_name': ProductName,
-                     'product_start': dateTimeStr,
-                     'processing_level': procesLevel,
-                     'spacecraft': spaceCraft,
-                     'orbit_direction': orbitDirection,
-                     'quantification_value': quantificationVal,
-                     'reflection_conversion': reflectConversion,
-                     'irradiance_values': e0})
-    # granule
-    XML_mask = 'MTD_TL.xml'
-    globlist = os.path.join(os.path.dirname(metadataFile), "GRANULE", "L1C_*", XML_mask)
-    metadataTile = glob.glob(globlist)[0]
-    # read metadata of tile
-    tree = ET.parse(metadataTile)
-    root = tree.getroot()
-    namespace = root.tag.split('}')[0]+'}'
-    # Get sun geometry - use the mean
-    baseNodePath = "./"+namespace+"Geometric_Info/Tile_Angles/"
-    sunGeometryNodeName = baseNodePath+"Mean_Sun_Angle/"
-    sunZen = root.find(sunGeometryNodeName+"ZENITH_ANGLE").text
-    sunAz = root.find(sunGeometryNodeName+"AZIMUTH_ANGLE").text
-    # Get sensor geometry - assume that all bands have the same angles
-    # (they differ slightly)
-    sensorGeometryNodeName = baseNodePath+"Mean_Viewing_Incidence_Angle_List/Mean_Viewing_Incidence_Angle/"
-    sensorZen = root.find(sensorGeometryNodeName+"ZENITH_ANGLE").text
-    sensorAz = root.find(sensorGeometryNodeName+"AZIMUTH_ANGLE").text
-    EPSG = tree.find("./"+namespace+"Geometric_Info/Tile_Geocoding/HORIZONTAL_CS_CODE").text
-    cldCoverPercent = tree.find("./"+namespace+"Quality_Indicators_Info/Image_Content_QI/CLOUDY_PIXEL_PERCENTAGE").text
-    for elem in tree.iter(tag='Size'):
-        if elem.attrib['resolution'] == '10':
-            rows_10 = int(elem[0].text)
-            cols_10 = int(elem[1].text)
-        if elem.attrib['resolution'] == '20':
-            rows_20 = int(elem[0].text)
-            cols_20 = int(elem[1].text)
-        if elem.attrib['resolution'] == '60':
-            rows_60 = int(elem[0].text)
-            cols_60 = int(elem[1].text)
-    for elem in tree.iter(tag='Geoposition'):
-        if elem.attrib['resolution'] == '10':
-            ULX_10 = int(elem[0].text)
-            ULY_10 = int(elem[1].text)
-        if elem.attrib['resolution'] == '20':
-            ULX_20 = int(elem[0].text)
-            ULY_20 = int(elem[1].text)
-        if elem.attrib['resolution'] == '60':
-            ULX_60 = int(elem[0].text)
-            ULY_60 = int(elem[1].text)
-
-    # save to dictionary
-    metaDict.update({'sun_zenit': sunZen,
-                     'sun_azimuth': sunAz,
-                     'sensor_zenit': sensorZen,
-                     'sensor_azimuth': sensorAz,
-                     'projection': EPSG,
-                     'cloudCoverPercent': cldCoverPercent,
-                     'rows_10': rows_10,
-                     'cols_10': cols_10,
-                     'rows_20': rows_20,
-                     'cols_20': cols_20,
-                     'rows_60': rows_60,
-                     'cols_60': cols_60,
-                     'ULX_10': ULX_10,
-                     'ULY_10': ULY_10,
-                     'ULX_20': ULX_20,
-                     'ULY_20': ULY_20,
-                     'ULX_60': ULX_60,
-                     'ULY_60': ULY_60})
-    return metaDict
+# Read the given bands (numbers) of a window of ds, into out (bands, ysize,
+# xsize) when given instead of new arrays
+def readBands(ds, bands, window, metrics=noMetrics, out=None):
+    xoff, yoff, xsize, ysize = window
+    rawData = []
+    for i in range(len(bands)):
+        start = time.time()
+        band = ds.GetRasterBand(bands[i])
+        if out is None:
+            rawData.append(band.ReadAsArray(xoff, yoff, xsize, ysize))
+        else:
+            rawData.append(band.ReadAsArray(xoff, yoff, xsize, ysize, buf_obj=out[i]))
+        metrics.add("read", i+1, time.time() - start, bytesRead=rawData[i].nbytes)
+    return rawData
 
 
-# save the data to geotiff or memory
-def saveImg(data, geotransform, proj, outPath, noDataValue=np.nan):
+# Size of the pixel data of all bands of an image in bytes
+def imageBytes(img):
+    return (img.RasterXSize * img.RasterYSize * img.RasterCount *
+            gdal.GetDataTypeSize(img.GetRasterBand(1).DataType) // 8)
+
+
+# Whether the input has integer DNs that fit in the DN histograms
+def hasDNType(inImg):
+    return inImg.GetRasterBand(1).DataType in (gdal.GDT_Byte, gdal.GDT_UInt16)
+
+
+# The contribution of one window of one band to the output statistics. This
+# is the histogram of the DNs when the output is a function of the DN only
+# (countDN), otherwise the count, sum, sum of squares, min and max of the
+# output values and their histogram over histRange. With halfFloat the values
+# are rounded to the half floats a Float16 output stores.
+def statisticsPart(rawData, data, countDN, histRange=None, halfFloat=False):
+    if countDN:
+        return dnCounts(rawData)
+    if halfFloat:
+        data = data.astype(np.float16)
+    return (data.size, float(np.sum(data, dtype=np.float64)),
+            float(np.sum(np.square(data, dtype=np.float64))),
+            float(data.min()), float(data.max()),
+            np.histogram(data, bins=histogramBuckets, range=histRange)[0])
+
+
+# Range of the histogram of output values which are not a function of the DN
+# only: 0 to the largest value the integer encodings store with scale, that
+# of UInt16 for float encodings
+def histogramRange(scale, encoding="Float32"):
+    dataType = outputEncodings[encoding][0]
+    if dataType not in integerEncodingRanges:
+        dataType = gdal.GDT_UInt16
+    return 0.0, integerEncodingRanges[dataType][1] / float(scale)
+
+
+# Add a window's contribution to the statistics of a band
+def addStatisticsPart(stats, part):
+    if stats is None:
+        return part
+    if isinstance(part, np.ndarray):
+        stats += part
+        return stats
+    return (stats[0] + part[0], stats[1] + part[1], stats[2] + part[2],
+            min(stats[3], part[3]), max(stats[4], part[4]), stats[5] + part[5])
+
+
+# Float16 bands are Float32 with NBITS=16, only in files
+def isHalfFloat(band):
+    return (band.DataType == gdal.GDT_Float32 and
+            band.GetMetadataItem("NBITS", "IMAGE_STRUCTURE") == "16")
+
+
+# Save the statistics and histogram of an output band, whose pixel values are
+# lut[DN], from the histogram of the DNs. As the values are computed with the
+# same kernel (and encoding) as the output, they match what GDAL would compute
+# by reading the band. Float16 bands store half floats, so the values are
+# rounded to half floats too.
+def setStatisticsFromDN(band, dnHist, lut):
+    values = encodeData(lut, band)
+    if isHalfFloat(band):
+        values = values.astype(np.float16)
+    values = values.astype(np.float64)
+    present = dnHist > 0
+    values = values[present]
+    counts = dnHist[present].astype(np.float64)
+    count = counts.sum()
+    if count == 0:
+        return
+    mean = np.dot(values, counts) / count
+    std = np.sqrt(max(np.dot((values - mean) ** 2, counts) / count, 0))
+    minValue, maxValue = values.min(), values.max()
+    band.SetStatistics(float(minValue), float(maxValue), float(mean), float(std))
+    band.SetMetadataItem("STATISTICS_VALID_PERCENT",
+                         str(100.0 * count / (band.XSize * band.YSize)))
+
+    hist = np.histogram(values, bins=histogramBuckets, range=(minValue, maxValue),
+                        weights=counts)[0]
+    band.SetDefaultHistogram(float(minValue), float(maxValue),
+                             [int(bucket) for bucket in hist])
+
+
+# Save the statistics and histogram of an output band from the accumulated
+# count, sum, sum of squares, min, max and histogram over histRange of its
+# values. Values outside histRange are not in the histogram.
+def setStatistics(band, stats, histRange):
+    if stats is None or stats[0] == 0:
+        return
+    count, total, totalSquares, minValue, maxValue, hist = stats
+    mean = total / count
+    std = np.sqrt(max(totalSquares / count - mean ** 2, 0))
+    low, high = histRange
+    # Statistics are of the stored values, which may be scaled integers
+    if band.DataType in integerEncodingRanges:
+        scale = band.GetScale()
+        minValue, maxValue = np.rint(minValue / scale), np.rint(maxValue / scale)
+        mean, std = mean / scale, std / scale
+        low, high = np.rint(low / scale), np.rint(high / scale)
+    band.SetStatistics(float(minValue), float(maxValue), float(mean), float(std))
+    band.SetMetadataItem("STATISTICS_VALID_PERCENT",
+                         str(100.0 * count / (band.XSize * band.YSize)))
+    band.SetDefaultHistogram(float(low), float(high), [int(bucket) for bucket in hist])
+
+
+# Write a (bands, ysize, xsize) window into the output image, and into its
+# overviews if it has any. The time includes the compression of the tiles
+# GDAL flushes from its cache while writing.
+def writeWindow(outImg, window, data, metrics=noMetrics):
+    xoff, yoff = window[0], window[1]
+    for i in range(data.shape[0]):
+        start = time.time()
+        band = outImg.GetRasterBand(i+1)
+        encoded = encodeData(data[i], band)
+        band.WriteArray(encoded, xoff, yoff)
+        metrics.add("write", i+1, time.time() - start, bytesWritten=encoded.nbytes)
+    if outImg.GetRasterBand(1).GetOverviewCount() > 0:
+        with metrics.stage("overviews"):
+            writeOverviewWindows(outImg, window, data)
+
+
+# Average the window down to every overview level of outImg (factors 2, 4,
+# 8, ...) and write it there, so the overviews are built while the window is
+# still in memory instead of by reading the whole output again. Each level is
+# computed from the previous one, weighting by the number of full resolution
+# pixels behind each value so that partial blocks at the image edge are
+# averaged correctly. The window offsets must be multiples of the largest
+# factor, which processingWindows ensures.
+def writeOverviewWindows(outImg, window, data):
+    xoff, yoff = window[0], window[1]
+    counts = np.ones(data.shape[1:], dtype=np.float32)
+    for level in range(outImg.GetRasterBand(1).GetOverviewCount()):
+        data, counts = halveWindow(data, counts)
+        xoff //= 2
+        yoff //= 2
+        for i in range(data.shape[0]):
+            band = outImg.GetRasterBand(i+1)
+            band.GetOverview(level).WriteArray(encodeData(data[i], band), xoff, yoff)
+
+
+# Copy the tiled GeoTIFF outImg, including its overviews, into a
+# Cloud-Optimized GeoTIFF and delete outImg. Uses the COG driver when GDAL has
+# it, otherwise a GeoTIFF with the overviews copied in front of the data,
+# which has the same layout.
+def saveCog(outImg, outPath, encoding="Float32", callback=None):
+    tmpPath = outImg.GetDescription()
+    outImg.FlushCache()
+    encodingOpt = outputEncodings[encoding][1]
+    driver = gdal.GetDriverByName("COG")
+    if driver is not None:
+        cogImg = driver.CreateCopy(outPath, outImg, 0, driverOptionsCOG + encodingOpt,
+                                   callback=callback)
+    else:
+        driver = gdal.GetDriverByName("GTiff")
+        cogImg = driver.CreateCopy(outPath, outImg, 0, driverOptionsCOG + encodingOpt +
+                                   ['TILED=YES', 'COPY_SRC_OVERVIEWS=YES'],
+                                   callback=callback)
+    # The copy was stopped by the callback or failed
+    if cogImg is None:
+        outImg = None
+        gdal.GetDriverByName("GTiff").Delete(tmpPath)
+        return None
+    # Statistics are copied with the band metadata, but not the histograms
+    for i in range(outImg.RasterCount):
+        hist = outImg.GetRasterBand(i+1).GetDefaultHistogram(force=0)
+        if hist is not None:
+            cogImg.GetRasterBand(i+1).SetDefaultHistogram(*hist)
+    outImg = None
+    gdal.GetDriverByName("GTiff").Delete(tmpPath)
+    return cogImg
+
+
+# Convert float data to the scaled integers stored in band, if it has an
+# integer type. Values outside the range of the type are clipped.
+def encodeData(data, band):
+    if band.DataType not in integerEncodingRanges:
+        return data
+    low, high, noData = integerEncodingRanges[band.DataType]
+    encoded = np.multiply(data, 1.0 / band.GetScale(), dtype=np.float32)
+    np.rint(encoded, out=encoded)
+    np.clip(encoded, low, high, out=encoded)
+    return encoded.astype(gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType))
+
+
+# Return a float32 buffer of at least bands x ysize x xsize, reusing buf if it
+# is big enough. The first window is always the largest, so normally only one
+# buffer is allocated per conversion.
+def windowBuffer(buf, xsize, ysize, bands, dtype=np.float32):
+    if (buf is None or buf.shape[0] < bands or buf.shape[1] < ysize or
+            buf.shape[2] < xsize or buf.dtype != dtype):
+        buf = np.empty((bands, ysize, xsize), dtype=dtype)
+    return buf
+
+
+# Return a flat buffer of at least bands * ysize * xsize elements of dtype,
+# reusing buf if it is big enough, and a contiguous (bands, ysize, xsize) view
+# of its start to read a window into
+def readBuffer(buf, xsize, ysize, bands, dtype):
+    size = bands * ysize * xsize
+    if buf is None or buf.size < size or buf.dtype != dtype:
+        buf = np.empty(size, dtype=dtype)
+    return buf, buf[:size].reshape(bands, ysize, xsize)
+
+
+# numpy type of the pixels of inImg as read by ReadAsArray
+def rawType(inImg):
+    return gdal_array.GDALTypeCodeToNumericTypeCode(inImg.GetRasterBand(1).DataType)
+
+
+# Apply windowFunction(ds, window) to every processing window of inImg (or to
+# the given windows) and yield (window, result) in window order.
+#
+# With more than one worker the windows are spread over that many threads.
+# GDAL datasets can not be shared between threads, so each thread opens its
+# own handle to the input file. Results are still yielded in window order and at
+# most 2*workers windows are in flight, so the output is identical to a serial
+# run and memory stays bounded. Inputs without a file name (e.g. MEM
+# datasets) are always processed serially.
+def mapWindows(inImg, windowFunction, workers=1, feedback=noFeedback, windows=None,
+               windowPixels=windowPixelsDefault):
+    if windows is None:
+        windows = processingWindows(inImg, windowPixels=windowPixels)
+    windows = list(windows)
+    inPath = inImg.GetDescription()
+    feedback.checkCanceled()
+
+    if workers <= 1 or not inPath:
+        for i, window in enumerate(windows):
+            yield window, windowFunction(inImg, window)
+            feedback.windowDone(i + 1, len(windows))
+        return
+
+    # Each thread reads and processes the next window once it gets a slot,
+    # which is given back when the caller takes the result
+    slots = queue.Queue()
+    for i in range(2 * workers):
+        slots.put(None)
+    nextWindow = iter(enumerate(windows))
+    windowLock = threading.Lock()
+    results = queue.Queue()
+    stop = threading.Event()
+    errors = []
+
+    def worker():
+        ds = gdal.Open(inPath)
+        try:
+            while True:
+                _waitFor(slots, stop)
+                with windowLock:
+                    item = next(nextWindow, None)
+                if item is None:
+                    return
+                index, window = item
+                results.put((index, window, windowFunction(ds, window)))
+        except _PipelineStopped:
+            pass
+        except Exception:
+            errors.append(sys.exc_info())
+            stop.set()
+
+    threads = [threading.Thread(target=worker) for i in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        # Results that arrived before the ones of earlier windows
+        waiting = {}
+        for index in range(len(windows)):
+            while index not in waiting:
+                try:
+                    item = _waitFor(results, stop)
+                except _PipelineStopped:
+                    # A thread failed
+                    raise errors[0][1]
+                waiting[item[0]] = item
+            index, window, result = waiting.pop(index)
+            slots.put(None)
+            yield window, result
+            feedback.windowDone(index + 1, len(windows))
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+# Raised in the threads of pipelineWindows and mapWindows when the processing
+# is stopped
+class _PipelineStopped(Exception):
+    pass
+
+
+# Get the next item of q, waiting with a timeout so that the threads notice
+# when stop is set
+def _waitFor(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    raise _PipelineStopped()
+
+
+# Process the windows of inImg in a three stage pipeline. Reader threads read
+# each window with readFunction(ds, window, raw), using their own dataset, where
+# raw is a (bufferBands, ysize, xsize) buffer of rawDtype to read into. Compute
+# threads convert the data with computeFunction(window, data, out), where out
+# is a float32 buffer of bufferBands bands. The calling thread is the writer
+# and passes the results to writeFunction(window, result) in window order, so
+# the output is written exactly as by a serial loop. At most maxInFlight
+# windows are between being read and written at any time, which bounds the
+# memory use whatever the speed of each stage. The buffers are reused from
+# window to window, the raw one as soon as the window is computed, so after
+# the first windows no pixel memory is allocated. Inputs without a file (MEM)
+# are processed serially.
+def pipelineWindows(inImg, readFunction, computeFunction, writeFunction, bufferBands,
+                    outImg=None, readers=1, workers=1, feedback=noFeedback,
+                    windowPixels=windowPixelsDefault, rawDtype=np.uint16):
+    windows = list(processingWindows(inImg, outImg, windowPixels))
+    inPath = inImg.GetDescription()
+    feedback.checkCanceled()
+
+    if not inPath:
+        buf = rawBuf = None
+        for i, window in enumerate(windows):
+            buf = windowBuffer(buf, window[2], window[3], bufferBands)
+            out = buf[:bufferBands, :window[3], :window[2]]
+            rawBuf, raw = readBuffer(rawBuf, window[2], window[3], bufferBands, rawDtype)
+            writeFunction(window, computeFunction(window, readFunction(inImg, window, raw),
+                                                  out))
+            feedback.windowDone(i + 1, len(windows))
+        return
+
+    readers = max(readers, 1)
+    workers = max(workers, 1)
+    maxInFlight = 2 * (readers + workers)
+    # A window can only be read after taking a slot, which is given back when
+    # it has been written
+    slots = queue.Queue()
+    for i in range(maxInFlight):
+        slots.put(None)
+    nextWindow = iter(enumerate(windows))
+    windowLock = threading.Lock()
+    readQueue = queue.Queue()
+    writeQueue = queue.Queue()
+    freeBuffers = deque()
+    freeRawBuffers = deque()
+    stop = threading.Event()
+    errors = []
+
+    def waitFor(q):
+        return _waitFor(q, stop)
+
+    def reader():
+        ds = gdal.Open(inPath)
+        try:
+            while True:
+                waitFor(slots)
+                with windowLock:
+                    item = next(nextWindow, None)
+                if item is None:
+                    return
+                index, window = item
+                try:
+                    rawBuf = freeRawBuffers.pop()
+                except IndexError:
+                    rawBuf = None
+                rawBuf, raw = readBuffer(rawBuf, window[2], window[3], bufferBands, rawDtype)
+                readQueue.put((index, window, readFunction(ds, window, raw), rawBuf))
+        except _PipelineStopped:
+            pass
+        except Exception:
+            errors.append(sys.exc_info())
+            stop.set()
+
+    def computer():
+        try:
+            while True:
+                index, window, data, rawBuf = waitFor(readQueue)
+                try:
+                    buf = freeBuffers.pop()
+                except IndexError:
+                    buf = None
+                buf = windowBuffer(buf, window[2], window[3], bufferBands)
+                out = buf[:bufferBands, :window[3], :window[2]]
+                result = computeFunction(window, data, out)
+                data = None
+                freeRawBuffers.append(rawBuf)
+                writeQueue.put((index, window, result, buf))
+        except _PipelineStopped:
+            pass
+        except Exception:
+            errors.append(sys.exc_info())
+            stop.set()
+
+    threads = ([threading.Thread(target=reader) for i in range(readers)] +
+               [threading.Thread(target=computer) for i in range(workers)])
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        # Results that arrived before the ones of earlier windows
+        waiting = {}
+        for index in range(len(windows)):
+            while index not in waiting:
+                try:
+                    item = waitFor(writeQueue)
+                except _PipelineStopped:
+                    # A reader or compute thread failed
+                    raise errors[0][1]
+                waiting[item[0]] = item
+            index, window, result, buf = waiting.pop(index)
+            writeFunction(window, result)
+            freeBuffers.append(buf)
+            slots.put(None)
+            feedback.windowDone(index + 1, len(windows))
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+# Split the image into processing windows following the native block layout
+# of the first band. Blocks are grouped so that each window holds at least
+# windowPixels pixels, which keeps striped (one row per block) files from
+# being read line by line. When outImg is given the window height is also
+# rounded up to whole output blocks, so that each output tile is written
+# (and compressed) once.
+def processingWindows(inImg, outImg=None, windowPixels=windowPixelsDefault):
+    cols = inImg.RasterXSize
+    rows = inImg.RasterYSize
+    outBlockY = 1
+    overviewCount = 0
+    if outImg is not None:
+        outBlockY = outImg.GetRasterBand(1).GetBlockSize()[1]
+        overviewCount = outImg.GetRasterBand(1).GetOverviewCount()
+    stepX, stepY = windowStep(cols, rows, inImg.GetRasterBand(1).GetBlockSize(),
+                              windowPixels, outBlockY, overviewCount)
+    for yoff in range(0, rows, stepY):
+        ysize = min(stepY, rows - yoff)
+        for xoff in range(0, cols, stepX):
+            xsize = min(stepX, cols - xoff)
+            yield xoff, yoff, xsize, ysize
+
+
+# hist can be given when the DN histograms have already been computed
+def darkObjectSubstraction(inImg, workers=1, hist=None):
+    # DN histograms of all bands in a single pass over the image
+    if hist is None:
+        hist = dnHistograms(inImg, workers=workers)
+    # Number of valid (non-zero) pixels in the first band
+    numElements = hist[0, 1:].sum()
+    return [int(offset) for offset in dosOffsets(hist[:, 1:2049], numElements)]
+
+
+# Estimate the DOS offsets from a stratified random sample of sampleFraction
+# of the image blocks: the blocks are split into consecutive (spatial) strata
+# and one random block of each stratum is read. The deviation of each offset
+# from the offset of the full image is estimated as the RMS difference with
+# the offsets of bootstrap resamples of the sampled blocks. Returns the
+# offsets and the deviations in DN, or None, None if the image has too few
+# blocks for sampling to save anything.
+#
+# The overviews of the input are not used: they are averaged (and the JP2
+# resolution levels are wavelet low-passes), which smooths away the dark
+# pixels the offset is based on.
+def approximateDarkObjectSubstraction(inImg, sampleFraction, workers=1, bootstrap=100,
+                                      seed=0, feedback=noFeedback):
+    blocks = list(processingWindows(inImg, windowPixels=dosSampleBlockPixels))
+    sampleCount = max(int(round(len(blocks) * sampleFraction)), dosMinSampleBlocks)
+    if sampleCount * 2 > len(blocks):
+        return None, None
+    random = np.random.RandomState(seed)
+    strata = np.linspace(0, len(blocks), sampleCount + 1).astype(int)
+    sample = [blocks[random.randint(strata[i], strata[i+1])] for i in range(sampleCount)]
+
+    def blockHistogram(ds, window):
+        lowHist = np.empty((ds.RasterCount, 2049), dtype=np.int64)
+        for i in range(ds.RasterCount):
+            counts = dnCounts(ds.GetRasterBand(i+1).ReadAsArray(*window))
+            lowHist[i] = counts[:2049]
+            if i == 0:
+                numElements = counts[1:].sum()
+        return lowHist[:, 1:], numElements
+
+    lowHists = []
+    numElements = []
+    for window, (lowHist, count) in mapWindows(inImg, blockHistogram, workers=workers,
+                                               windows=sample, feedback=feedback):
+        lowHists.append(lowHist)
+        numElements.append(count)
+    lowHists = np.array(lowHists)
+    numElements = np.array(numElements)
+
+    offsets = dosOffsets(lowHists.sum(axis=0), numElements.sum())
+    # Number of times each sampled block is drawn in each resample
+    weights = random.multinomial(sampleCount, [1.0 / sampleCount] * sampleCount,
+                                 size=bootstrap)
+    resampledOffsets = dosOffsets(np.tensordot(weights, lowHists, axes=1),
+                                  np.dot(weights, numElements))
+    deviation = np.sqrt(np.mean((resampledOffsets - offsets) ** 2.0, axis=0))
+    return [int(offset) for offset in offsets], [float(d) for d in deviation]
+
+
+# Count the occurence of every 16-bit DN value in each band, reading the image
+# window by window. Returns an array of shape (bands, 65536).
+def dnHistograms(inImg, workers=1, feedback=noFeedback, windowPixels=windowPixelsDefault):
+    # Each thread reads the bands into its own buffer
+    threadData = threading.local()
+    dtype = rawType(inImg)
+
+    def windowHistogram(ds, window):
+        xoff, yoff, xsize, ysize = window
+        threadData.buf, data = readBuffer(getattr(threadData, "buf", None), xsize, ysize, 1,
+                                          dtype)
+        counts = []
+        for i in range(ds.RasterCount):
+            ds.GetRasterBand(i+1).ReadAsArray(xoff, yoff, xsize, ysize, buf_obj=data[0])
+            counts.append(dnCounts(data[0]))
+        return counts
+
+    hist = np.zeros((inImg.RasterCount, dnRange), dtype=np.int64)
+    for window, counts in mapWindows(inImg, windowHistogram, workers=workers,
+                                     feedback=feedback, windowPixels=windowPixels):
+        for i in range(len(counts)):
+            hist[i] += counts[i]
+    return hist
+
+
+# create an empty image in geotiff or memory. Set tiled to get a GeoTIFF
+# suitable for writing window by window. With an integer encoding the values
+# are stored multiplied by scale, and noDataValue is replaced by the no-data
+# value of the integer type. With overviews, empty overviews for a COG are
+# added to a GeoTIFF, to be filled by writeWindow. With scratchDir a memory
+# image is backed by a memory-mapped file in that directory, see memmapImg.
+def createImg(cols, rows, bands, geotransform, proj, outPath, noDataValue=np.nan, tiled=True,
+              encoding="Float32", scale=reflectanceScale, overviews=False, scratchDir=None):
 
     # Start the gdal driver for GeoTIFF
     if outPath == "MEM":
         driver = gdal.GetDriverByName("MEM")
         driverOpt = []
+    elif tiled:
+        driver = gdal.GetDriverByName("GTiff")
+        driverOpt = driverOptionsGTiffTiled
     else:
         driver = gdal.GetDriverByName("GTiff")
         driverOpt = driverOptionsGTiff
 
+    dataType, encodingOpt = outputEncodings[encoding]
+    if outPath != "MEM":
+        driverOpt = driverOpt + encodingOpt
+    if dataType in integerEncodingRanges:
+        noDataValue = integerEncodingRanges[dataType][2]
+
+    if outPath == "MEM" and scratchDir is not None:
+        ds = memmapImg(cols, rows, bands, dataType, scratchDir)
+    else:
+        ds = driver.Create(outPath, cols, rows, bands, dataType, driverOpt)
+    ds.SetProjection(proj)
+    ds.SetGeoTransform(geotransform)
+    for i in range(bands):
+        band = ds.GetRasterBand(i+1)
+        band.SetNoDataValue(noDataValue)
+        if dataType in integerEncodingRanges:
+            band.SetScale(1.0 / scale)
+            band.SetOffset(0)
+    if overviews and outPath != "MEM" and overviewFactors(cols, rows):
+        ds.BuildOverviews("NONE", overviewFactors(cols, rows))
+
+    return ds
+
+
+# Create a MEM image whose pixels are held in an np.memmap of a scratch file
+# in scratchDir. The pages are written back to the file instead of to swap
+# when memory is short. The file is deleted when the image is closed (it has
+# no name on POSIX systems).
+def memmapImg(cols, rows, bands, dataType, scratchDir):
+    scratch = np.memmap(tempfile.TemporaryFile(dir=scratchDir), mode="w+",
+                        dtype=gdal_array.GDALTypeCodeToNumericTypeCode(dataType),
+                        shape=(bands, rows, cols))
+    ds = gdal.GetDriverByName("MEM").Create("", cols, rows, 0, dataType)
+    for i in range(bands):
+        ds.AddBand(dataType, ["DATAPOINTER=%d" % scratch[i].ctypes.data,
+                              "PIXELOFFSET=%d" % scratch.strides[2],
+                              "LINEOFFSET=%d" % scratch.strides[1]])
+    # The MEM driver does not own the pixels, so the array has to live as long
+    # as the image
+    ds.scratchArray = scratch
+    return ds
+
+
+# save the data to geotiff or memory
+def saveImg(data, geotransform, proj, outPath, noDataValue=np.nan, encoding="Float32",
+            scale=reflectanceScale):
+
     shape = data.shape
     if len(shape) > 2:
-        ds = driver.Create(outPath, shape[1], shape[0], shape[2], gdal.GDT_Float32, driverOpt)
-        ds.SetProjection(proj)
-        ds.SetGeoTransform(geotransform)
+        ds = createImg(shape[1], shape[0], shape[2], geotransform, proj, outPath, noDataValue,
+                       tiled=False, encoding=encoding, scale=scale)
         for i in range(shape[2]):
-            ds.GetRasterBand(i+1).WriteArray(data[:, :, i])
-            ds.GetRasterBand(i+1).SetNoDataValue(noDataValue)
+            band = ds.GetRasterBand(i+1)
+            band.WriteArray(encodeData(data[:, :, i], band))
     else:
-        ds = driver.Create(outPath, shape[1], shape[0], 1, gdal.GDT_Float32)
-        ds.SetProjection(proj)
-        ds.SetGeoTransform(geotransform)
-        ds.GetRasterBand(1).WriteArray(data)
-        ds.GetRasterBand(1).SetNoDataValue(noDataValue)
+        ds = createImg(shape[1], shape[0], 1, geotransform, proj, outPath, noDataValue,
+                       tiled=False, encoding=encoding, scale=scale)
+        band = ds.GetRasterBand(1)
+        band.WriteArray(encodeData(data, band))
 
     return ds
 
 
-def saveImgByCopy(outImg, outPath):
+def saveImgByCopy(outImg, outPath, encoding="Float32", scale=reflectanceScale):
 
-    driver = gdal.GetDriverByName("GTiff")
-    savedImg = driver.CreateCopy(outPath, outImg, 0, driverOptionsGTiff)
+    dataType, encodingOpt = outputEncodings[encoding]
+    # Results in memory already hold the scaled integers of their encoding
+    if (dataType not in integerEncodingRanges or
+            outImg.GetRasterBand(1).DataType == dataType):
+        driver = gdal.GetDriverByName("GTiff")
+        savedImg = driver.CreateCopy(outPath, outImg, 0, driverOptionsGTiff + encodingOpt)
+    else:
+        # Convert to scaled integers window by window
+        savedImg = createImg(outImg.RasterXSize, outImg.RasterYSize, outImg.RasterCount,
+                             outImg.GetGeoTransform(), outImg.GetProjection(), outPath,
+                             tiled=False, encoding=encoding, scale=scale)
+        for window in processingWindows(outImg):
+            data = np.array([outImg.GetRasterBand(i+1).ReadAsArray(*window)
+                             for i in range(outImg.RasterCount)])
+            writeWindow(savedImg, window, data)
     savedImg = None
     outImg = None
 
@@ -22,8 +22,10 @@
 """
 
 import os
-from PyQt4 import QtGui, uic
-from atmProcessing import atmProcessingMain, saveImgByCopy
+import uuid
+import threading
+import traceback
+from PyQt4 import QtCore, QtGui, uic
 
 FORM_CLASS, _ = uic.loadUiType(os.path.join(
     os.path.dirname(__file__), 'atmospheric_correction_dialog_base.ui'))
@@ -38,9 +40,20 @@ class atmCorrectionDialog(QtGui.QDialog, FORM_CLASS):
         self.toolButton_DN.clicked.connect(self.selectDN)
         self.toolButton_meta.clicked.connect(self.selectMeta)
         self.toolButton_output.clicked.connect(self.selectOutput)
-        self.pushButton_cancel.clicked.connect(self.closeWindow)
+        self.pushButton_cancel.clicked.connect(self.cancelOrClose)
         self.pushButton_save.clicked.connect(self.runAtmCorrection)
 
+        # The correction runs in a background thread so that QGIS stays
+        # responsive
+        self.thread = None
+        self.worker = None
+        # The preview layer (id) on the map and its file in /vsimem/. They
+        # are kept when the dialog is closed, so that the preview can be
+        # inspected on the map, and replaced by the next preview. The plugin
+        # removes them when it is unloaded.
+        self.previewLayer = None
+        self.previewFile = None
+
     def selectDN(self):
         self.lineEdit_DN.setText(QtGui.QFileDialog.getOpenFileName(
                 self, "Select DN file", ""))
@@ -56,6 +69,30 @@ class atmCorrectionDialog(QtGui.QDialog, FORM_CLASS):
     def closeWindow(self):
         self.close()
 
+    def cancelOrClose(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            self.pushButton_cancel.setEnabled(False)
+        else:
+            self.closeWindow()
+
+    def closeEvent(self, event):
+        # Closing the dialog cancels a running correction
+        if self.worker is not None:
+            self.worker.cancel()
+        super(atmCorrectionDialog, self).closeEvent(event)
+
+    def removePreview(self):
+        if self.previewFile is None:
+            return
+        from osgeo import gdal
+        if self.previewLayer is not None:
+            from qgis.core import QgsMapLayerRegistry
+            QgsMapLayerRegistry.instance().removeMapLayer(self.previewLayer)
+        gdal.Unlink(self.previewFile)
+        self.previewLayer = None
+        self.previewFile = None
+
     def satellite(self):
         index = self.comboBox_satellite.currentIndex()
         sensorList = ["L8", "L7", "S2A_10m", "S2A_60m"]
@@ -74,7 +111,90 @@ class atmCorrectionDialog(QtGui.QDialog, FORM_CLASS):
         options["metadataFile"] = self.lineEdit_meta.text()
         options["reflectanceFile"] = self.lineEdit_output.text()
         options["atmCorrMethod"] = self.method()
+        # Quick-look at reduced resolution, added to the map instead of being
+        # saved to the output file
+        options["preview"] = self.checkBox_preview.isChecked()
+        # Keep the output in the result cache, and copy it from there if the
+        # same correction was run before
+        if self.checkBox_useCache.isChecked():
+            from resultCache import resultCacheDir
+            options["resultCacheDir"] = resultCacheDir
+            options["resultCacheLink"] = True
+
+        self.worker = atmCorrectionWorker(options)
+        self.thread = QtCore.QThread(self)
+        self.worker.moveToThread(self.thread)
+        self.thread.started.connect(self.worker.run)
+        self.worker.progress.connect(self.progressBar.setValue)
+        self.worker.finished.connect(self.workerFinished)
+        self.progressBar.setValue(0)
+        self.pushButton_save.setEnabled(False)
+        self.thread.start()
+
+    def workerFinished(self, status, message):
+        self.thread.quit()
+        self.thread.wait()
+        self.thread = None
+        self.worker = None
+        self.pushButton_save.setEnabled(True)
+        self.pushButton_cancel.setEnabled(True)
+        if status == "finished":
+            self.accept()
+        elif status == "preview":
+            # message is the file the preview was saved to
+            from qgis.utils import iface
+            self.removePreview()
+            self.previewFile = message
+            layer = iface.addRasterLayer(message, "Atmospheric correction preview")
+            if layer is not None:
+                self.previewLayer = layer.id()
+        elif status == "failed":
+            self.progressBar.setValue(0)
+            QtGui.QMessageBox.critical(self, "Atmospheric correction", message)
+        else:
+            # Canceled, the partial output has been deleted
+            self.progressBar.setValue(0)
+
+
+class atmCorrectionWorker(QtCore.QObject):
+    # Runs atmProcessingMain in a QThread. progress is emitted with the
+    # percentage done after every processing window and finished with
+    # "finished", "preview" and the file of the preview, "canceled" or
+    # "failed" and the error message. cancel() stops the processing at the
+    # next window.
+    progress = QtCore.pyqtSignal(int)
+    finished = QtCore.pyqtSignal(str, str)
+
+    def __init__(self, options):
+        super(atmCorrectionWorker, self).__init__()
+        self.options = options
+        self.canceled = threading.Event()
+
+    def run(self):
+        from atmProcessing import ProcessingCanceled, saveImgByCopy
+        from resultCache import cachedAtmProcessingMain
+
+        options = dict(self.options)
+        options["progress"] = lambda percent: self.progress.emit(int(percent))
+        options["isCanceled"] = self.canceled.is_set
+        try:
+            # The result is written straight to the output file, or copied
+            # from the result cache if the same correction was run before.
+            # Closing the dataset finishes the write. Previews are returned in
+            # memory.
+            reflectanceImg = cachedAtmProcessingMain(options)
+            status, message = "finished", ""
+            if options["preview"]:
+                previewFile = "/vsimem/atmCorrection_preview_%s.tif" % uuid.uuid4().hex
+                saveImgByCopy(reflectanceImg, previewFile)
+                status, message = "preview", previewFile
+            reflectanceImg = None
+        except ProcessingCanceled:
+            self.finished.emit("canceled", "")
+        except Exception:
+            self.finished.emit("failed", traceback.format_exc())
+        else:
+            self.finished.emit(status, message)
 
-        reflectanceImg = atmProcessingMain(options)
-        saveImgByCopy(reflectanceImg, options["reflectanceFile"])
-        self.closeWindow()
+    def cancel(self):
+        self.canceled.set()
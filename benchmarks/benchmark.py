@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the atmospheric correction on synthetic Sentinel-2 L1C products.
+
+For every scene size and method (DOS, TOA, RAD) atmProcessingMain is run in a
+fresh process and the wall time, pixels per second and peak RSS are recorded.
+The results are saved as JSON and can be compared with an earlier run:
+
+    python benchmarks/benchmark.py --sizes 1000 2500 --output results.json
+    python benchmarks/benchmark.py --sizes 1000 2500 --compare results.json
+
+Use --kernels arithmetic lut to compare the conversion kernels.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import multiprocessing
+
+try:
+    import queue as queueModule
+except ImportError:
+    import Queue as queueModule
+
+benchmarkDir = os.path.dirname(os.path.abspath(__file__))
+pluginDir = os.path.dirname(benchmarkDir)
+for folder in (pluginDir, benchmarkDir):
+    if folder not in sys.path:
+        sys.path.insert(0, folder)
+
+methodList = ["DOS", "TOA", "RAD"]
+kernelList = ["arithmetic", "lut"]
+
+
+def peakRSS():
+    # Peak resident set size of this process in bytes
+    import resource
+    maxRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return maxRSS
+    return maxRSS * 1024
+
+
+def runCase(options, queue):
+    # Runs in a child process so that the peak RSS belongs to this case only
+    from atmProcessing import atmProcessingMain
+    import read_satellite_metadata
+
+    # The temporary products are not kept in the metadata cache
+    read_satellite_metadata.metadataCacheDir = None
+
+    startTime = time.time()
+    reflectanceImg = atmProcessingMain(options)
+    reflectanceImg = None
+    queue.put({'seconds': time.time() - startTime, 'peakRSS': peakRSS()})
+
+
+# Run one case in a child process. If the child dies without a result (e.g.
+# killed when out of memory) the case is recorded as failed with its exit code.
+def benchmarkCase(options):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=runCase, args=(options, queue))
+    process.start()
+    result = None
+    while result is None:
+        try:
+            result = queue.get(timeout=1)
+        except queueModule.Empty:
+            if not process.is_alive():
+                # The result may have been sent just before the child exited
+                try:
+                    result = queue.get(timeout=1)
+                except queueModule.Empty:
+                    break
+    process.join()
+    if result is None:
+        return {'failed': True, 'exitcode': process.exitcode, 'seconds': None,
+                'peakRSS': None}
+    return result
+
+
+def runBenchmarks(sizes, bands, methods, workers, repeat, tiled, workDir,
+                  kernels=("arithmetic",)):
+    from syntheticProduct import createSyntheticProduct
+
+    results = []
+    for size in sizes:
+        productDir = os.path.join(workDir, "%d" % size)
+        os.makedirs(productDir)
+        metadataFile, dnFile = createSyntheticProduct(productDir, size, size, bands,
+                                                      tiled=tiled)
+        for method in methods:
+            for kernel in kernels:
+                options = {"dnFile": dnFile,
+                           "metadataFile": metadataFile,
+                           "reflectanceFile": os.path.join(productDir, method + ".tif"),
+                           "atmCorrMethod": method,
+                           "workers": workers,
+                           "kernel": kernel}
+                # Radiance is only computed for the visible and NIR bands
+                outBands = min(bands, 9) if method == "RAD" else bands
+                for run in range(repeat):
+                    result = benchmarkCase(options)
+                    pixels = size * size * outBands
+                    result.update({'method': method, 'kernel': kernel, 'rows': size,
+                                   'cols': size, 'bands': bands, 'workers': workers,
+                                   'run': run})
+                    if result.get('failed'):
+                        result['pixelsPerSecond'] = None
+                    else:
+                        result['pixelsPerSecond'] = pixels / result['seconds']
+                    results.append(result)
+                    printResult(result)
+                    if os.path.exists(options["reflectanceFile"]):
+                        os.remove(options["reflectanceFile"])
+        shutil.rmtree(productDir)
+    return results
+
+
+def printResult(result, previous=None):
+    if result.get('failed'):
+        print("%-3s %-10s %6d x %-6d %2d bands  failed (exit code %s)" % (
+            result['method'], result.get('kernel', 'arithmetic'), result['rows'],
+            result['cols'], result['bands'], result['exitcode']))
+        return
+    line = "%-3s %-10s %6d x %-6d %2d bands  %8.2f s  %10.3g px/s  %8.1f MB" % (
+        result['method'], result.get('kernel', 'arithmetic'), result['rows'],
+        result['cols'], result['bands'],
+        result['seconds'], result['pixelsPerSecond'], result['peakRSS'] / 1024.0**2)
+    if previous is not None:
+        line += "  time x%.2f  RSS x%.2f" % (result['seconds'] / previous['seconds'],
+                                            result['peakRSS'] / float(previous['peakRSS']))
+    print(line)
+
+
+# Print the best time of each case together with its ratio to the best time
+# of the same case in an earlier run
+def compareResults(results, previousFile):
+    with open(previousFile) as f:
+        previous = json.load(f)['results']
+    print("\nCompared with %s:" % previousFile)
+    best = bestResults(results)
+    previousBest = bestResults(previous)
+    for key in sorted(best):
+        printResult(best[key], previousBest.get(key))
+
+
+def bestResults(results):
+    best = {}
+    for result in results:
+        if result.get('failed'):
+            continue
+        # Results saved before the kernels were benchmarked used arithmetic
+        key = (result['method'], result.get('kernel', 'arithmetic'), result['rows'],
+               result['cols'], result['bands'], result['workers'])
+        if key not in best or result['seconds'] < best[key]['seconds']:
+            best[key] = result
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of the atmospheric correction")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 2500, 5000],
+                        help="scene sizes in pixels (rows = cols)")
+    parser.add_argument("--bands", type=int, default=13)
+    parser.add_argument("--methods", nargs="+", default=methodList, choices=methodList)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--kernels", nargs="+", default=["arithmetic"], choices=kernelList,
+                        help="conversion kernels to benchmark (default: arithmetic)")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--tiled", action="store_true", help="use a tiled DN file")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", default=None,
+                        help="results of an earlier run to compare with")
+    parser.add_argument("--work-dir", default=None,
+                        help="directory for the synthetic products (default: temporary)")
+    args = parser.parse_args(argv)
+
+    from osgeo import gdal
+    import numpy as np
+
+    workDir = tempfile.mkdtemp(dir=args.work_dir)
+    try:
+        results = runBenchmarks(args.sizes, args.bands, args.methods, args.workers,
+                                args.repeat, args.tiled, workDir, args.kernels)
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    report = {'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+              'platform': platform.platform(),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'gdal': gdal.__version__,
+              'cpus': multiprocessing.cpu_count(),
+              'results': results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    if args.compare:
+        compareResults(results, args.compare)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Generator of synthetic Sentinel-2 L1C products for benchmarking.
+
+A product consists of a <name>.SAFE directory with MTD_MSIL1C.xml and
+GRANULE/L1C_<tile>/MTD_TL.xml files, and a uint16 GeoTIFF with the DN values
+of all bands. GDAL is only needed for the GeoTIFF.
+"""
+import os
+
+import numpy as np
+
+# Number of points in the 5 km angle grids of a 10980 x 10980 pixel tile
+angleGridSize = 23
+angleGridStep = 5000
+tileULX = 499980
+tileULY = 5200020
+
+productXml = """<?xml version="1.0" encoding="UTF-8"?>
+<n1:Level-1C_User_Product xmlns:n1="https://psd-14.sentinel2.eo.esa.int/PSD/User_Product_Level-1C.xsd">
+  <n1:General_Info>
+    <Product_Info>
+      <PRODUCT_START_TIME>2017-06-01T10:20:21.026Z</PRODUCT_START_TIME>
+      <PROCESSING_LEVEL>Level-1C</PROCESSING_LEVEL>
+      <Datatake datatakeIdentifier="GS2A_20170601T102021_010142_N02.05">
+        <SPACECRAFT_NAME>Sentinel-2A</SPACECRAFT_NAME>
+        <SENSING_ORBIT_DIRECTION>DESCENDING</SENSING_ORBIT_DIRECTION>
+      </Datatake>
+    </Product_Info>
+    <Product_Image_Characteristics>
+      <QUANTIFICATION_VALUE unit="none">10000</QUANTIFICATION_VALUE>
+      <Reflectance_Conversion>
+        <U>0.971</U>
+        <Solar_Irradiance_List>
+%(irradiance)s
+        </Solar_Irradiance_List>
+      </Reflectance_Conversion>
+    </Product_Image_Characteristics>
+  </n1:General_Info>
+</n1:Level-1C_User_Product>
+"""
+
+tileXml = """<?xml version="1.0" encoding="UTF-8"?>
+<n1:Level-1C_Tile_ID xmlns:n1="https://psd-14.sentinel2.eo.esa.int/PSD/S2_PDI_Level-1C_Tile_Metadata.xsd">
+  <n1:Geometric_Info>
+    <Tile_Geocoding metadataLevel="Brief">
+      <HORIZONTAL_CS_NAME>WGS84 / UTM zone 32N</HORIZONTAL_CS_NAME>
+      <HORIZONTAL_CS_CODE>EPSG:32632</HORIZONTAL_CS_CODE>
+%(sizes)s
+    </Tile_Geocoding>
+    <Tile_Angles metadataLevel="Standard">
+      <Sun_Angles_Grid>
+        <Zenith>
+          <COL_STEP unit="m">%(step)d</COL_STEP>
+          <ROW_STEP unit="m">%(step)d</ROW_STEP>
+          <Values_List>
+%(zenith)s
+          </Values_List>
+        </Zenith>
+        <Azimuth>
+          <COL_STEP unit="m">%(step)d</COL_STEP>
+          <ROW_STEP unit="m">%(step)d</ROW_STEP>
+          <Values_List>
+%(azimuth)s
+          </Values_List>
+        </Azimuth>
+      </Sun_Angles_Grid>
+      <Mean_Sun_Angle>
+        <ZENITH_ANGLE unit="deg">%(meanZenith).6f</ZENITH_ANGLE>
+        <AZIMUTH_ANGLE unit="deg">150.0</AZIMUTH_ANGLE>
+      </Mean_Sun_Angle>
+      <Mean_Viewing_Incidence_Angle_List>
+%(viewing)s
+      </Mean_Viewing_Incidence_Angle_List>
+    </Tile_Angles>
+  </n1:Geometric_Info>
+  <n1:Quality_Indicators_Info metadataLevel="Standard">
+    <Image_Content_QI>
+      <CLOUDY_PIXEL_PERCENTAGE>10.0</CLOUDY_PIXEL_PERCENTAGE>
+    </Image_Content_QI>
+  </n1:Quality_Indicators_Info>
+</n1:Level-1C_Tile_ID>
+"""
+
+# Sentinel-2A solar irradiance of the 13 bands
+solarIrradiance = [1913.57, 1941.63, 1822.61, 1512.79, 1425.56, 1288.32, 1163.19,
+                   1036.39, 955.19, 813.04, 367.15, 245.59, 85.25]
+
+
+def createSyntheticProduct(outDir, rows, cols, bands=13, name="S2A_MSIL1C_SYNTHETIC",
+                           tiled=False, seed=0):
+    # Returns the paths of the MTD_MSIL1C.xml file and the DN file
+    metadataFile = createSyntheticMetadata(outDir, rows, cols, bands, name)
+    dnFile = os.path.join(outDir, name + ".tif")
+    _createDNFile(dnFile, rows, cols, bands, tiled, seed)
+    return metadataFile, dnFile
+
+
+def createSyntheticMetadata(outDir, rows, cols, bands=13, name="S2A_MSIL1C_SYNTHETIC"):
+    # Returns the path of the MTD_MSIL1C.xml file
+    safeDir = os.path.join(outDir, name + ".SAFE")
+    granuleDir = os.path.join(safeDir, "GRANULE", "L1C_T32UNA_A000000_20170601T102021")
+    if not os.path.isdir(granuleDir):
+        os.makedirs(granuleDir)
+
+    irradiance = "\n".join(
+        '          <SOLAR_IRRADIANCE bandId="%d" unit="W/m2/um">%.2f</SOLAR_IRRADIANCE>' %
+        (i, solarIrradiance[i % len(solarIrradiance)]) for i in range(bands))
+    metadataFile = os.path.join(safeDir, "MTD_MSIL1C.xml")
+    with open(metadataFile, "w") as f:
+        f.write(productXml % {'irradiance': irradiance})
+
+    with open(os.path.join(granuleDir, "MTD_TL.xml"), "w") as f:
+        f.write(tileXml % _tileValues(rows, cols, bands))
+    return metadataFile
+
+
+def _tileValues(rows, cols, bands):
+    sizes = []
+    for resolution in (10, 20, 60):
+        factor = resolution // 10
+        sizes.append('      <Size resolution="%d">\n'
+                     '        <NROWS>%d</NROWS>\n'
+                     '        <NCOLS>%d</NCOLS>\n'
+                     '      </Size>' % (resolution, rows // factor, cols // factor))
+    for resolution in (10, 20, 60):
+        sizes.append('      <Geoposition resolution="%d">\n'
+                     '        <ULX>%d</ULX>\n'
+                     '        <ULY>%d</ULY>\n'
+                     '        <XDIM>%d</XDIM>\n'
+                     '        <YDIM>%d</YDIM>\n'
+                     '      </Geoposition>' % (resolution, tileULX, tileULY,
+                                                resolution, -resolution))
+
+    # Sun zenith increasing slightly towards the south east of the tile
+    gridIndex = np.arange(angleGridSize)
+    zenith = 35.0 + 0.1 * gridIndex[:, np.newaxis] + 0.05 * gridIndex[np.newaxis, :]
+    azimuth = np.full(zenith.shape, 150.0)
+
+    viewing = "\n".join(
+        '        <Mean_Viewing_Incidence_Angle bandId="%d">\n'
+        '          <ZENITH_ANGLE unit="deg">5.0</ZENITH_ANGLE>\n'
+        '          <AZIMUTH_ANGLE unit="deg">100.0</AZIMUTH_ANGLE>\n'
+        '        </Mean_Viewing_Incidence_Angle>' % i for i in range(bands))
+
+    return {'sizes': "\n".join(sizes),
+            'step': angleGridStep,
+            'zenith': _gridValues(zenith),
+            'azimuth': _gridValues(azimuth),
+            'meanZenith': zenith.mean(),
+            'viewing': viewing}
+
+
+def _gridValues(grid):
+    return "\n".join('            <VALUES>%s</VALUES>' % " ".join("%.4f" % value for value in row)
+                     for row in grid)
+
+
+# DN values of a vegetated scene, with a dark tail starting a little above 0
+# so that the dark object substraction has something to find, and a border of
+# no-data (0) pixels.
+def _createDNFile(dnFile, rows, cols, bands, tiled, seed):
+    from osgeo import gdal, osr
+
+    driverOpt = ['TILED=YES'] if tiled else []
+    driver = gdal.GetDriverByName("GTiff")
+    ds = driver.Create(dnFile, cols, rows, bands, gdal.GDT_UInt16, driverOpt)
+    ds.SetGeoTransform((tileULX, 10, 0, tileULY, 0, -10))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32632)
+    ds.SetProjection(srs.ExportToWkt())
+
+    random = np.random.RandomState(seed)
+    border = max(1, cols // 50)
+    stripRows = max(1, (4 * 1024 * 1024) // cols)
+    for band in range(bands):
+        darkDN = 100 + 20 * band
+        for yoff in range(0, rows, stripRows):
+            ysize = min(stripRows, rows - yoff)
+            data = darkDN + random.gamma(2.0, 400.0, (ysize, cols))
+            data = np.clip(data, 1, 20000).astype(np.uint16)
+            data[:, :border] = 0
+            ds.GetRasterBand(band+1).WriteArray(data, 0, yoff)
+    ds = None
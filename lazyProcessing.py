@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Lazy atmospheric correction with dask and xarray.
+
+atmProcessingLazy returns the reflectance (or radiance) as an xarray DataArray
+backed by a dask array instead of a GDAL dataset. Every chunk of every band is
+one task which reads the DNs of the chunk and converts them, so band math,
+masking and reductions applied to the array are evaluated chunk by chunk, in
+parallel, together with the correction, and the whole reflectance cube is
+never held in memory. dask and xarray are only needed by this module.
+"""
+import threading
+
+import numpy as np
+from osgeo import gdal
+
+try:
+    import dask
+    import dask.array as da
+    import xarray as xr
+except ImportError:
+    # atmProcessingLazy raises an ImportError when it is used without them
+    dask = da = xr = None
+
+from atmProcessing import reflectanceKernel, radianceKernel, cosSunZenithGrid, \
+    cosSunZenithWindow, dosOffsetsFor, radianceScales, safeVrtXml, windowStep, s2Bands, \
+    s2BandResolutions, windowPixelsDefault
+from read_satellite_metadata import readMetadataS2L1C
+
+# Dataset opened by the chunk tasks of each thread
+_threadData = threading.local()
+
+
+# Same options as atmProcessingMain, the output options (reflectanceFile,
+# outputEncoding, outputProfile...) are ignored. Returns a (band, y, x)
+# float32 DataArray with the band names, x and y pixel centre coordinates and
+# the CRS (WKT) and affine transform of the input in its attributes, or a
+# dictionary of them by resolution with nativeResolution. chunks is the
+# (rows, columns) of the chunks, by default whole input blocks of about
+# windowPixels pixels. The DOS offsets are computed when the array is created.
+def atmProcessingLazy(options, chunks=None):
+    if xr is None or da is None:
+        raise ImportError("atmProcessingLazy needs dask and xarray, install them with "
+                          "pip install dask xarray")
+
+    dnFile = options.get("dnFile")
+    metadataFile = readMetadataS2L1C(options["metadataFile"])
+
+    if options.get("nativeResolution", False):
+        if dnFile:
+            raise ValueError("Native resolution processing reads the bands from the "
+                             "product, a DN file can not be used")
+        return dict((resolution,
+                     _lazyArray(safeVrtXml(metadataFile, s2BandResolutions[resolution]),
+                                metadataFile, options, s2BandResolutions[resolution],
+                                chunks))
+                    for resolution in sorted(s2BandResolutions))
+
+    if dnFile:
+        return _lazyArray(dnFile, metadataFile, options, None, chunks)
+    bandIds = list(range(len(metadataFile.irradiance_values)))
+    return _lazyArray(safeVrtXml(metadataFile, bandIds), metadataFile, options, bandIds,
+                      chunks)
+
+
+# The lazy array of the bands of source, a file name or VRT XML
+def _lazyArray(source, metadataFile, options, bandIds, chunks):
+    atmCorrMethod = options["atmCorrMethod"]
+    workers = int(options.get("workers", 1))
+    inImg = gdal.Open(source)
+    cols = inImg.RasterXSize
+    rows = inImg.RasterYSize
+    geotransform = inImg.GetGeoTransform()
+    projection = inImg.GetProjection()
+    if bandIds is None:
+        bandIds = list(range(inImg.RasterCount))
+    qv = metadataFile.quantification_value
+
+    # Conversion and its parameters for each band, with the DOS offsets and
+    # radiance factors of toaReflectanceS2 and toaRadianceS2
+    windowPixels = int(options.get("windowPixels", windowPixelsDefault))
+    attrs = {}
+    if atmCorrMethod in ["DOS", "TOA"]:
+        bands = list(range(1, inImg.RasterCount + 1))
+        dosDN = [0] * inImg.RasterCount
+        if atmCorrMethod == "DOS":
+            dosDN, dosDeviation, hist = dosOffsetsFor(
+                inImg, options.get("dosSampleFraction"),
+                float(options.get("dosTolerance", 1.0)), workers, windowPixels)
+            attrs["dos_offsets"] = [int(offset) for offset in dosDN]
+            if dosDeviation is not None:
+                attrs["dos_offset_deviations"] = [float(deviation)
+                                                  for deviation in dosDeviation]
+        conversions = [("reflectance", (dosDN[i], qv)) for i in range(len(bands))]
+        name = "reflectance"
+    elif atmCorrMethod == "RAD":
+        perPixelSun = options.get("perPixelSun", False)
+        bands, scale = radianceScales(metadataFile, bandIds, perPixelSun)
+        cosZenithGrid = cosSunZenithGrid(metadataFile) if perPixelSun else None
+        conversions = [("radiance", (scale[i], cosZenithGrid, geotransform))
+                       for i in range(len(bands))]
+        name = "radiance"
+    else:
+        raise ValueError("Unknown atmospheric correction method %s" % atmCorrMethod)
+
+    if chunks is None:
+        stepX, stepY = windowStep(cols, rows, inImg.GetRasterBand(1).GetBlockSize(),
+                                  windowPixels)
+    else:
+        stepY, stepX = chunks
+    inImg = None
+
+    # One task per chunk of each band, so that selecting bands only reads them
+    convert = dask.delayed(convertChunk, pure=True)
+    bandArrays = []
+    for band, (conversion, parameters) in zip(bands, conversions):
+        blocks = []
+        for yoff in range(0, rows, stepY):
+            blockRow = []
+            for xoff in range(0, cols, stepX):
+                window = (xoff, yoff, min(stepX, cols - xoff), min(stepY, rows - yoff))
+                blockRow.append(da.from_delayed(
+                    convert(source, band, window, conversion, parameters),
+                    (window[3], window[2]), dtype=np.float32))
+            blocks.append(blockRow)
+        bandArrays.append(da.block(blocks))
+
+    attrs["crs"] = projection
+    # Affine transform in the rasterio order, and the GDAL geotransform
+    attrs["transform"] = (geotransform[1], geotransform[2], geotransform[0],
+                          geotransform[4], geotransform[5], geotransform[3])
+    attrs["geotransform"] = tuple(geotransform)
+    attrs["atmCorrMethod"] = atmCorrMethod
+    coords = {"band": [s2Bands[bandIds[band-1]] for band in bands],
+              "y": geotransform[3] + geotransform[5] * (np.arange(rows) + 0.5),
+              "x": geotransform[0] + geotransform[1] * (np.arange(cols) + 0.5)}
+    return xr.DataArray(da.stack(bandArrays), dims=("band", "y", "x"), coords=coords,
+                        attrs=attrs, name=name)
+
+
+# Read one window of one band (number) of source and convert it to
+# reflectance (parameters (dos, qv)) or radiance (parameters (scale,
+# cosZenithGrid, geotransform), cosZenithGrid None for the mean sun angle)
+# with the kernels of atmProcessingMain, which give identical values
+def convertChunk(source, band, window, conversion, parameters):
+    xoff, yoff, xsize, ysize = window
+    rawData = _openDataset(source).GetRasterBand(band).ReadAsArray(xoff, yoff, xsize, ysize)
+    out = np.empty((ysize, xsize), dtype=np.float32)
+    if conversion == "reflectance":
+        dos, qv = parameters
+        reflectanceKernel(rawData, dos, qv, out)
+    else:
+        scale, cosZenithGrid, geotransform = parameters
+        radianceKernel(rawData, scale, out)
+        if cosZenithGrid is not None:
+            out *= cosSunZenithWindow(cosZenithGrid, geotransform, window)
+    return out
+
+
+# GDAL datasets can not be shared between threads, so each thread keeps its
+# own handle of the last source it read
+def _openDataset(source):
+    if getattr(_threadData, "source", None) != source:
+        _threadData.ds = gdal.Open(source)
+        _threadData.source = source
+    return _threadData.ds
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+The numpy parts of the atmospheric correction, which do not need GDAL.
+
+The conversion kernels and their lookup tables, the DN counts and the dark
+object offset search, the geometry of the processing windows and overviews,
+and the interpolation of the sun zenith angle grid. atmProcessing imports
+them from here, so they can also be used and tested without GDAL.
+"""
+import os
+
+import numpy as np
+
+from read_satellite_metadata import readSunAngleGridS2L1C
+
+# Overviews are added until the smallest one fits in one tile of this size
+cogTileSize = 256
+# Number of possible DN values in Sentinel-2 L1C (uint16) images
+dnRange = 65536
+# The approximate DOS samples whole input blocks, as reading part of a block
+# (a 1024 x 1024 JP2 block of a Sentinel-2 band) decodes all of it anyway.
+# Smaller blocks (strips, small tiles) are combined into sample blocks of
+# about dosSampleBlockPixels pixels per band. At least dosMinSampleBlocks are
+# sampled, which is 13 % of a 10980 x 10980 tile read from its JP2 files.
+dosSampleBlockPixels = 256 * 256
+dosMinSampleBlocks = 16
+# Approximate number of pixels per band read in one processing window
+windowPixelsDefault = 1024 * 1024
+# cos(sun zenith) grids already read, keyed by tile metadata file and mtime
+_cosSunZenithGrids = {}
+# Sentinel-2 bands in the order of the bandId in the metadata
+s2Bands = ['B01', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B08', 'B8A',
+           'B09', 'B10', 'B11', 'B12']
+# bandIds of the bands at each native resolution (m)
+s2BandResolutions = {10: [1, 2, 3, 7],
+                     20: [4, 5, 6, 8, 11, 12],
+                     60: [0, 9, 10]}
+
+
+# (DN - dos) / qv, clipped at 0, computed in float32 into out
+def reflectanceKernel(rawData, dos, qv, out):
+    np.subtract(rawData, dos, out=out, dtype=np.float32)
+    np.maximum(out, 0, out=out)
+    np.divide(out, qv, out=out, dtype=np.float32)
+    return out
+
+
+# DN * scale computed in float32 into out
+def radianceKernel(rawData, scale, out):
+    np.multiply(rawData, scale, out=out, dtype=np.float32)
+    return out
+
+
+# Look up the value of every DN of rawData in table (see reflectanceTable)
+# into out. mode="clip" avoids a temporary copy of out, 8 and 16 bit DNs are
+# always within the table.
+def lookupKernel(rawData, table, out):
+    np.take(table, rawData, out=out, mode="clip")
+    return out
+
+
+# Reflectance of every 16-bit DN, computed with the same kernel as the
+# windows so that lookupKernel gives identical results
+def reflectanceTable(dos, qv):
+    return reflectanceKernel(np.arange(dnRange, dtype=np.uint16), dos, qv,
+                             np.empty(dnRange, dtype=np.float32))
+
+
+# Radiance of every 16-bit DN
+def radianceTable(scale):
+    return radianceKernel(np.arange(dnRange, dtype=np.uint16), scale,
+                          np.empty(dnRange, dtype=np.float32))
+
+
+# Number of occurences of every 16-bit DN value in data
+def dnCounts(data):
+    if data.dtype != np.uint16:
+        data = np.clip(data, 0, dnRange-1).astype(np.uint16)
+    return np.bincount(data.ravel(), minlength=dnRange)
+
+
+# The dark object is where the low end of the histogram first rises sharply.
+# lowHist holds the counts of DNs 1 to 2048 of each band (the 2048 bins of
+# np.histogram(data, bins=2048, range=(1, 2048))) in its last axis, and
+# numElements the number of valid pixels. Any leading axes are computed in
+# one go, numElements then has those axes.
+def dosOffsets(lowHist, numElements):
+    numElements = np.asarray(numElements, dtype=np.float64)
+    threshold = numElements-numElements*0.999999
+    rising = np.diff(lowHist, axis=-1) > threshold[..., np.newaxis, np.newaxis]
+    return np.where(rising.any(axis=-1), rising.argmax(axis=-1), 0)
+
+
+# Width and height of the processing windows of an image of cols x rows
+# pixels with the given block size, written to an output with blocks of
+# outBlockY rows and overviewCount overviews
+def windowStep(cols, rows, blockSize, windowPixels=windowPixelsDefault, outBlockY=1,
+               overviewCount=0):
+    blockX = min(max(blockSize[0], 1), cols)
+    blockY = min(max(blockSize[1], 1), rows)
+    # Strips span the whole width, so stack them vertically. Tiles are
+    # processed one at a time, but grown vertically when they are tiny.
+    stepY = blockY * max(1, windowPixels // (blockX * blockY))
+    stepX = blockX
+    stepY = -(-stepY // outBlockY) * outBlockY
+    # Overviews are written from each window, so the windows must start on
+    # whole blocks of the largest overview factor
+    if overviewCount > 0:
+        factor = 2 ** overviewCount
+        stepY = -(-stepY // factor) * factor
+        stepX = -(-stepX // factor) * factor
+    return stepX, min(stepY, rows)
+
+
+# Overview factors for a COG, halving until the smallest overview fits in
+# one tile
+def overviewFactors(cols, rows):
+    factors = []
+    factor = 2
+    while -(-max(cols, rows) // (factor // 2)) > cogTileSize:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+# Average 2 x 2 blocks of a (bands, ysize, xsize) array of means, where counts
+# is the number of pixels behind each mean. Odd sizes give a partial last
+# block. Returns the new means and counts.
+def halveWindow(data, counts):
+    bands, ysize, xsize = data.shape
+    weighted = data * counts
+    if ysize % 2 or xsize % 2:
+        weighted = np.pad(weighted, ((0, 0), (0, ysize % 2), (0, xsize % 2)), 'constant')
+        counts = np.pad(counts, ((0, ysize % 2), (0, xsize % 2)), 'constant')
+    halfY, halfX = counts.shape[0] // 2, counts.shape[1] // 2
+    sums = weighted.reshape(bands, halfY, 2, halfX, 2).sum(axis=(2, 4))
+    counts = counts.reshape(halfY, 2, halfX, 2).sum(axis=(1, 3))
+    return sums / counts, counts
+
+
+# Coarse grid of cos(sun zenith) for the tile of the product, together with
+# its upper left corner and spacing in map units. The grid is only read from
+# MTD_TL.xml once per tile.
+def cosSunZenithGrid(metadataFile):
+    tileFile = metadataFile.tile_metadata_file
+    key = (tileFile, os.path.getmtime(tileFile))
+    if key not in _cosSunZenithGrids:
+        grids = readSunAngleGridS2L1C(tileFile)
+        zenith = np.array(grids['zenith'], dtype=np.float64)
+        # Fill missing grid points with the scene mean
+        zenith[np.isnan(zenith)] = metadataFile.sun_zenit
+        _cosSunZenithGrids[key] = (np.cos(np.radians(zenith)).astype(np.float32),
+                                   metadataFile.ULX_10, metadataFile.ULY_10,
+                                   grids['col_step'], grids['row_step'])
+    return _cosSunZenithGrids[key]
+
+
+# Bilinearly interpolate the coarse cos(sun zenith) grid at the pixel centres
+# of one window. The interpolation is done along the grid rows first, which
+# leaves only a (ysize, grid columns) array to interpolate along the columns.
+def cosSunZenithWindow(cosZenithGrid, geotransform, window):
+    grid, ulx, uly, colStep, rowStep = cosZenithGrid
+    xoff, yoff, xsize, ysize = window
+    x = geotransform[0] + (xoff + np.arange(xsize) + 0.5) * geotransform[1]
+    y = geotransform[3] + (yoff + np.arange(ysize) + 0.5) * geotransform[5]
+    gridX = np.clip((x - ulx) / colStep, 0, grid.shape[1] - 1)
+    gridY = np.clip((uly - y) / rowStep, 0, grid.shape[0] - 1)
+    col = np.minimum(gridX.astype(int), grid.shape[1] - 2)
+    row = np.minimum(gridY.astype(int), grid.shape[0] - 2)
+    fracX = (gridX - col).astype(np.float32)
+    fracY = (gridY - row).astype(np.float32)[:, np.newaxis]
+
+    rowInterp = grid[row] * (1 - fracY) + grid[row + 1] * fracY
+    cosZenith = rowInterp[:, col] * (1 - fracX)
+    cosZenith += rowInterp[:, col + 1] * fracX
+    return cosZenith
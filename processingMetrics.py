@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Timing and memory instrumentation of the atmospheric correction.
+
+A ProcessingMetrics object passed to atmProcessingMain in options["metrics"]
+(or created when options["metricsFile"] is given) records, for every stage of
+the processing (metadata parsing, DOS histograms, band reads, computation,
+writing, flushing, COG copy...), the wall time and the bytes read and written,
+in total and per output band, and the memory of the process: its resident
+memory at the end of the stage, the largest increase of the resident memory
+over one call of the stage (for the stages timed with stage()) and the peak
+resident memory of the process so far.
+"""
+import os
+import sys
+import json
+import time
+import cProfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the peak memory is then not recorded
+    resource = None
+
+
+# Peak resident memory of the process so far in bytes, None if unknown
+def peakMemory():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == "darwin":
+        return peak
+    return peak * 1024
+
+
+# Current resident memory of the process in bytes, None if unknown (only
+# available on Linux)
+def currentMemory():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError, AttributeError):
+        return None
+
+
+def _newRecord():
+    return OrderedDict([("seconds", 0.0), ("calls", 0), ("bytesRead", 0),
+                        ("bytesWritten", 0)])
+
+
+class ProcessingMetrics(object):
+    # The stages are recorded in the order they are first seen. Stages that
+    # run in the worker threads (read, compute) add up the time of all
+    # threads, so their seconds can be larger than the wall time of the run.
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.prefix = ""
+        self._lock = threading.Lock()
+
+    # Add one measurement to a stage, and to the band (output band number)
+    # if given. memoryIncrease is the change of the resident memory over the
+    # measurement, if known. Can be called from several threads.
+    def add(self, name, band=None, seconds=0.0, bytesRead=0, bytesWritten=0,
+            memoryIncrease=None):
+        memory = currentMemory()
+        processPeak = peakMemory()
+        with self._lock:
+            stage = self.stages.get(self.prefix + name)
+            if stage is None:
+                stage = _newRecord()
+                stage["memory"] = None
+                stage["memoryIncrease"] = None
+                stage["processPeakMemory"] = None
+                stage["bands"] = OrderedDict()
+                self.stages[self.prefix + name] = stage
+            records = [stage]
+            if band is not None:
+                records.append(stage["bands"].setdefault(str(band), _newRecord()))
+            for record in records:
+                record["seconds"] += seconds
+                record["calls"] += 1
+                record["bytesRead"] += int(bytesRead)
+                record["bytesWritten"] += int(bytesWritten)
+            stage["memory"] = memory
+            if memoryIncrease is not None and (stage["memoryIncrease"] is None or
+                                               memoryIncrease > stage["memoryIncrease"]):
+                stage["memoryIncrease"] = memoryIncrease
+            # The high-water mark of the whole process, which never goes down
+            stage["processPeakMemory"] = processPeak
+
+    # Time the body of a with statement as one measurement of a stage
+    @contextmanager
+    def stage(self, name, band=None, bytesRead=0, bytesWritten=0):
+        start = time.time()
+        startMemory = currentMemory()
+        try:
+            yield
+        finally:
+            memoryIncrease = None
+            if startMemory is not None:
+                memoryIncrease = currentMemory() - startMemory
+            self.add(name, band, time.time() - start, bytesRead, bytesWritten,
+                     memoryIncrease)
+
+    # Record the stages in the body of a with statement under "<section>/",
+    # e.g. one section per resolution in native resolution processing
+    @contextmanager
+    def section(self, name):
+        prefix = self.prefix
+        self.prefix = prefix + name + "/"
+        try:
+            yield
+        finally:
+            self.prefix = prefix
+
+    def toDict(self):
+        with self._lock:
+            return OrderedDict([("peakMemory", peakMemory()),
+                                ("stages", json.loads(json.dumps(self.stages)))])
+
+    def save(self, metricsFile):
+        with open(metricsFile, "w") as f:
+            json.dump(self.toDict(), f, indent=2)
+
+
+# Used when no metrics are wanted, so that the processing does not have to
+# check for them
+class NoMetrics(ProcessingMetrics):
+
+    def add(self, name, band=None, seconds=0.0, bytesRead=0, bytesWritten=0,
+            memoryIncrease=None):
+        pass
+
+    @contextmanager
+    def stage(self, name, band=None, bytesRead=0, bytesWritten=0):
+        yield
+
+
+noMetrics = NoMetrics()
+
+
+# Run the body of a with statement under cProfile and save the statistics to
+# profileFile (for pstats or snakeviz). Only the calling thread is profiled,
+# the windows processed by worker threads show up as waiting time.
+@contextmanager
+def profiled(profileFile):
+    if not profileFile:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        directory = os.path.dirname(os.path.abspath(profileFile))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        profiler.dump_stats(profileFile)
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Memory planning of the atmospheric correction.
+
+planProcessing predicts the peak memory and the bytes read and written by
+atmProcessingMain for a set of options, and, given a memory budget, picks the
+processing window size, the number of worker and reader threads and the GDAL
+block cache size so that the run stays under the budget. atmProcessingMain
+uses it when options["memoryBudget"] is given, and returns the plan without
+processing anything when options["dryRun"] is set. GDAL is only needed to
+read a DN file and the current GDAL cache size.
+"""
+from processingCore import windowStep, overviewFactors, s2BandResolutions, dnRange, \
+    windowPixelsDefault, cogTileSize, dosSampleBlockPixels, dosMinSampleBlocks
+from read_satellite_metadata import readMetadataS2L1C
+
+# Memory used by the process before it reads any image data
+baseMemoryBytes = 200 * 1024 * 1024
+# Window sizes (pixels per band) tried by the planner, after the requested one
+windowPixelsChoices = [1024 * 1024, 512 * 1024, 256 * 1024, 128 * 1024, 64 * 1024]
+# Smallest GDAL block cache the planner gives a run, and the largest it
+# takes from the budget
+gdalCacheMin = 32 * 1024 * 1024
+gdalCachePreferred = 512 * 1024 * 1024
+# Block size of the JP2 files of Sentinel-2 products, decoded whole by the
+# readers
+jp2BlockPixels = 1024 * 1024
+# Bytes per pixel of the output encodings (atmProcessing.outputEncodings)
+# while they are processed, Float16 is only packed when it is written
+outputEncodingBytes = {'Float32': 4, 'Float16': 4, 'UInt16': 2, 'Int16': 2}
+
+
+# Plan a run of atmProcessingMain with the given options. Returns a dict with
+# the chosen workers, readers, windowPixels and gdalCacheMax, the predicted
+# peakMemory, bytesRead and bytesWritten (uncompressed), and whether the run
+# fits in memoryBudget (always True without a budget).
+def planProcessing(options, memoryBudget=None):
+    rasters = describeInputs(options)
+    workers = max(int(options.get("workers", 1)), 1)
+    readers = max(int(options.get("readers", 1)), 1)
+    windowPixels = int(options.get("windowPixels", windowPixelsDefault))
+
+    if memoryBudget is None:
+        from osgeo import gdal
+        gdalCache = gdal.GetCacheMax()
+        plan = _plan(rasters, options, workers, readers, windowPixels, gdalCache)
+        plan['fits'] = True
+        return plan
+
+    # Keep as many workers as possible, then the largest windows, and give
+    # what is left of the budget to the GDAL cache
+    threads = [(workers, r) for r in range(readers, 0, -1)]
+    threads += [(w, 1) for w in range(workers - 1, 0, -1)]
+    windowChoices = [windowPixels] + [choice for choice in windowPixelsChoices
+                                      if choice < windowPixels]
+    for threadWorkers, threadReaders in threads:
+        for choice in windowChoices:
+            plan = _plan(rasters, options, threadWorkers, threadReaders, choice, 0)
+            available = memoryBudget - plan['peakMemory']
+            if available >= gdalCacheMin:
+                cache = min(available, gdalCachePreferred)
+                plan = _plan(rasters, options, threadWorkers, threadReaders, choice, cache)
+                plan['fits'] = True
+                return plan
+    # Nothing fits, return the smallest plan
+    plan = _plan(rasters, options, 1, 1, windowChoices[-1], gdalCacheMin)
+    plan['fits'] = False
+    return plan
+
+
+# Size, band count, DN data type and block size of the inputs processed one
+# after the other by the run: the DN file, the bands of the product, or the
+# bands of each resolution in native resolution processing
+def describeInputs(options):
+    if options.get("dnFile"):
+        from osgeo import gdal
+        inImg = gdal.Open(options["dnFile"])
+        raster = {'cols': inImg.RasterXSize, 'rows': inImg.RasterYSize,
+                  'bands': inImg.RasterCount,
+                  'inBytes': gdal.GetDataTypeSize(inImg.GetRasterBand(1).DataType) // 8,
+                  'blockSize': inImg.GetRasterBand(1).GetBlockSize(), 'jp2': False}
+        inImg = None
+        rasters = [raster]
+    else:
+        metadata = readMetadataS2L1C(options["metadataFile"])
+        if options.get("nativeResolution", False):
+            resolutions = [(resolution, s2BandResolutions[resolution])
+                           for resolution in sorted(s2BandResolutions)]
+        else:
+            resolutions = [(10, list(range(len(metadata.irradiance_values))))]
+        rasters = []
+        for resolution, bandIds in resolutions:
+            cols = getattr(metadata, "cols_%d" % resolution)
+            rows = getattr(metadata, "rows_%d" % resolution)
+            rasters.append({'cols': cols, 'rows': rows, 'bandIds': bandIds,
+                            'bands': len(bandIds), 'inBytes': 2,
+                            'blockSize': [min(1024, cols), min(1024, rows)], 'jp2': True})
+
+    # Radiance is only computed for the visible and NIR bands
+    for raster in rasters:
+        bandIds = raster.pop('bandIds', range(raster['bands']))
+        if options.get("atmCorrMethod") == "RAD":
+            raster['outBands'] = len([bandId for bandId in bandIds if bandId < 9])
+        else:
+            raster['outBands'] = raster['bands']
+
+    # Previews process a decimated copy of at most previewSize pixels
+    if options.get("preview", False):
+        previewSize = float(options.get("previewSize", 1024))
+        for raster in rasters:
+            factor = max(max(raster['cols'], raster['rows']) / previewSize, 1.0)
+            raster['cols'] = max(int(round(raster['cols'] / factor)), 1)
+            raster['rows'] = max(int(round(raster['rows'] / factor)), 1)
+            raster['blockSize'] = [cogTileSize, cogTileSize]
+            raster['jp2'] = False
+    return rasters
+
+
+def _plan(rasters, options, workers, readers, windowPixels, gdalCache):
+    inMemory = not options.get("reflectanceFile") or options.get("preview", False)
+    outBytes = outputEncodingBytes[options.get("outputEncoding", "Float32")]
+    cog = options.get("outputProfile", "GTiff") == "COG" and not inMemory
+    dos = options.get("atmCorrMethod") == "DOS"
+    exactDOS = dos and not options.get("dosSampleFraction")
+
+    peakMemory = 0
+    memoryOutputs = 0
+    bytesRead = 0
+    bytesWritten = 0
+    for raster in rasters:
+        cols, rows, bands, outBands = (raster['cols'], raster['rows'], raster['bands'],
+                                       raster['outBands'])
+        inBytes = raster['inBytes']
+        pixels = cols * rows
+        overviewCount = len(overviewFactors(cols, rows)) if cog else 0
+        # MEM outputs have one row per block, GeoTIFF outputs 256 x 256 tiles
+        stepX, stepY = windowStep(cols, rows, raster['blockSize'], windowPixels,
+                                  1 if inMemory else 256, overviewCount)
+        windowPx = stepX * stepY
+
+        # Conversion pipeline: raw DNs, float32 results and per-window DN
+        # counts of every window in flight, the encoded band and overviews in
+        # the writer, and the lookup tables and statistics
+        inFlight = 2 * (readers + workers)
+        statsBytes = bands * dnRange * 8
+        perWindow = bands * windowPx * (inBytes + 4) + (0 if exactDOS else statsBytes)
+        writer = windowPx * outBytes + (bands * windowPx * 2 if overviewCount else 0)
+        conversion = inFlight * perWindow + writer + bands * dnRange * 4 + statsBytes
+        # DOS histogram pass: one band read and the counts of all bands of
+        # each window in flight
+        histogram = 0
+        if exactDOS:
+            histogramInFlight = 2 * workers + 1 if workers > 1 else 1
+            histogram = (histogramInFlight * (windowPx * inBytes + statsBytes + dnRange * 8) +
+                         statsBytes)
+        # The JP2 driver decodes whole blocks in each reading thread
+        decoding = (readers + workers) * jp2BlockPixels * 4 * 2 if raster['jp2'] else 0
+
+        # Results in memory are paged out to the scratch file when given
+        if inMemory and not options.get("scratchDir"):
+            memoryOutputs += pixels * outBands * outBytes
+        peakMemory = max(peakMemory, memoryOutputs + max(conversion, histogram) + decoding)
+
+        # The DOS offsets are computed from a first pass over the image, or
+        # over the sampled blocks
+        if exactDOS:
+            passes = 2
+        elif dos:
+            passes = 1 + sampledFraction(raster, float(options["dosSampleFraction"]))
+        else:
+            passes = 1
+        bytesRead += int(pixels * bands * inBytes * passes)
+        written = pixels * outBands * outBytes
+        if overviewCount:
+            # Overviews add a third, and the COG copy writes everything again
+            written = 2 * (written + written // 3)
+        if not inMemory:
+            bytesWritten += written
+
+    return {'workers': workers, 'readers': readers, 'windowPixels': windowPixels,
+            'gdalCacheMax': gdalCache,
+            'peakMemory': baseMemoryBytes + gdalCache + peakMemory,
+            'bytesRead': bytesRead, 'bytesWritten': bytesWritten}
+
+
+# Fraction of the raster read by the approximate DOS, as in
+# approximateDarkObjectSubstraction: whole blocks, at least
+# dosMinSampleBlocks, and the whole image when that would be more than half
+def sampledFraction(raster, sampleFraction):
+    stepX, stepY = windowStep(raster['cols'], raster['rows'], raster['blockSize'],
+                              dosSampleBlockPixels)
+    blocks = -(-raster['cols'] // stepX) * -(-raster['rows'] // stepY)
+    sampleCount = max(int(round(blocks * sampleFraction)), dosMinSampleBlocks)
+    if sampleCount * 2 > blocks:
+        return 1.0
+    return float(sampleCount) / blocks
+
+
+def formatPlan(plan):
+    megabyte = 1024.0 ** 2
+    lines = ["workers:          %d" % plan['workers'],
+             "readers:          %d" % plan['readers'],
+             "window pixels:    %d" % plan['windowPixels'],
+             "GDAL cache:       %.0f MB" % (plan['gdalCacheMax'] / megabyte),
+             "peak memory:      %.0f MB" % (plan['peakMemory'] / megabyte),
+             "bytes read:       %.0f MB" % (plan['bytesRead'] / megabyte),
+             "bytes written:    %.0f MB (uncompressed)" % (plan['bytesWritten'] / megabyte)]
+    if not plan['fits']:
+        lines.append("The run does not fit in the memory budget even with the smallest plan")
+    return "\n".join(lines)
@@ -1,96 +1,200 @@
 import os
-from xml.etree import ElementTree as ET
 import glob
+import json
+import hashlib
+from collections import namedtuple
+from xml.etree import ElementTree as ET
 
-def readMetadataS2L1C(metadataFile):
-    # Get parameters from main metadata file
-    ProductName = os.path.split(os.path.dirname(metadataFile))[1]
-    tree = ET.parse(metadataFile)
-    root = tree.getroot()
-    namespace = root.tag.split('}')[0]+'}'
-
-    baseNodePath = "./"+namespace+"General_Info/Product_Info/"
-    dateTimeStr = root.find(baseNodePath+"PRODUCT_START_TIME").text
-    procesLevel = root.find(baseNodePath+"PROCESSING_LEVEL").text
-    spaceCraft = root.find(baseNodePath+"Datatake/SPACECRAFT_NAME").text
-    orbitDirection = root.find(baseNodePath+"Datatake/SENSING_ORBIT_DIRECTION").text
-
-    baseNodePath = "./"+namespace+"General_Info/Product_Image_Characteristics/"
-    quantificationVal = root.find(baseNodePath+"QUANTIFICATION_VALUE").text
-    reflectConversion = root.find(baseNodePath+"Reflectance_Conversion/U").text
-    irradianceNodes = root.findall(baseNodePath+"Reflectance_Conversion/Solar_Irradiance_List/SOLAR_IRRADIANCE")
-    e0 = []
-    for node in irradianceNodes:
-        e0.append(node.text)
-
-    # save to dictionary
-    metaDict = {}
-    metaDict.update({'product_name': ProductName,
-                     'product_start': dateTimeStr,
-                     'processing_level': procesLevel,
-                     'spacecraft': spaceCraft,
-                     'orbit_direction': orbitDirection,
-                     'quantification_value': quantificationVal,
-                     'reflection_conversion': reflectConversion,
-                     'irradiance_values': e0})
+# Directory where parsed metadata is cached between runs. Set to None to
+# disable the on-disk cache.
+metadataCacheDir = os.path.join(os.path.expanduser("~"), ".atmCorrection", "metadata")
+# Number of products kept in the on-disk cache, the least recently used are
+# removed beyond it
+metadataCacheMaxEntries = 500
+
+# Values read from MTD_MSIL1C.xml and the granule MTD_TL.xml. Angles, values
+# and sizes are already converted to numbers.
+S2L1CMetadata = namedtuple('S2L1CMetadata', [
+    'product_name', 'product_start', 'processing_level', 'spacecraft',
+    'orbit_direction', 'quantification_value', 'reflection_conversion',
+    'irradiance_values', 'tile_metadata_file',
+    'sun_zenit', 'sun_azimuth', 'sensor_zenit', 'sensor_azimuth',
+    'projection', 'cloudCoverPercent',
+    'rows_10', 'cols_10', 'rows_20', 'cols_20', 'rows_60', 'cols_60',
+    'ULX_10', 'ULY_10', 'ULX_20', 'ULY_20', 'ULX_60', 'ULY_60'])
+
+# Metadata already read by this process, keyed like the on-disk cache
+_metadataMemoryCache = {}
+
+
+# cacheDir is the directory of the on-disk cache, metadataCacheDir when None
+def readMetadataS2L1C(metadataFile, cacheDir=None):
+    if cacheDir is None:
+        cacheDir = metadataCacheDir
     # granule
     XML_mask = 'MTD_TL.xml'
     globlist = os.path.join(os.path.dirname(metadataFile), "GRANULE", "L1C_*", XML_mask)
     metadataTile = glob.glob(globlist)[0]
+
+    # The metadata is only parsed again if one of the files changed
+    key = (os.path.abspath(metadataFile), os.path.getmtime(metadataFile),
+           os.path.abspath(metadataTile), os.path.getmtime(metadataTile))
+    if key in _metadataMemoryCache:
+        return _metadataMemoryCache[key]
+    metadata = _loadCachedMetadata(key, cacheDir)
+    if metadata is None:
+        metadata = _parseMetadataS2L1C(metadataFile, metadataTile)
+        _saveCachedMetadata(key, metadata, cacheDir)
+    _metadataMemoryCache[key] = metadata
+    return metadata
+
+
+def _parseMetadataS2L1C(metadataFile, metadataTile):
+    # Get parameters from main metadata file
+    metaDict = {'product_name': os.path.split(os.path.dirname(metadataFile))[1],
+                'tile_metadata_file': metadataTile}
+    e0 = {}
+    for path, elem in _iterElements(metadataFile):
+        tag = path[-1][0]
+        parent = path[-2][0] if len(path) > 1 else None
+        if tag == "PRODUCT_START_TIME":
+            metaDict['product_start'] = elem.text
+        elif tag == "PROCESSING_LEVEL":
+            metaDict['processing_level'] = elem.text
+        elif tag == "SPACECRAFT_NAME":
+            metaDict['spacecraft'] = elem.text
+        elif tag == "SENSING_ORBIT_DIRECTION":
+            metaDict['orbit_direction'] = elem.text
+        elif tag == "QUANTIFICATION_VALUE":
+            metaDict['quantification_value'] = float(elem.text)
+        elif tag == "U" and parent == "Reflectance_Conversion":
+            metaDict['reflection_conversion'] = float(elem.text)
+        elif tag == "SOLAR_IRRADIANCE":
+            e0[int(elem.attrib.get('bandId', len(e0)))] = float(elem.text)
+        elif tag == "Product_Image_Characteristics":
+            # Nothing more is needed from this file
+            break
+    metaDict['irradiance_values'] = tuple(e0[band] for band in sorted(e0))
+
     # read metadata of tile
-    tree = ET.parse(metadataTile)
-    root = tree.getroot()
-    namespace = root.tag.split('}')[0]+'}'
-    # Get sun geometry - use the mean
-    baseNodePath = "./"+namespace+"Geometric_Info/Tile_Angles/"
-    sunGeometryNodeName = baseNodePath+"Mean_Sun_Angle/"
-    sunZen = root.find(sunGeometryNodeName+"ZENITH_ANGLE").text
-    sunAz = root.find(sunGeometryNodeName+"AZIMUTH_ANGLE").text
-    # Get sensor geometry - assume that all bands have the same angles
-    # (they differ slightly)
-    sensorGeometryNodeName = baseNodePath+"Mean_Viewing_Incidence_Angle_List/Mean_Viewing_Incidence_Angle/"
-    sensorZen = root.find(sensorGeometryNodeName+"ZENITH_ANGLE").text
-    sensorAz = root.find(sensorGeometryNodeName+"AZIMUTH_ANGLE").text
-    EPSG = tree.find("./"+namespace+"Geometric_Info/Tile_Geocoding/HORIZONTAL_CS_CODE").text
-    cldCoverPercent = tree.find("./"+namespace+"Quality_Indicators_Info/Image_Content_QI/CLOUDY_PIXEL_PERCENTAGE").text
-    for elem in tree.iter(tag='Size'):
-        if elem.attrib['resolution'] == '10':
-            rows_10 = int(elem[0].text)
-            cols_10 = int(elem[1].text)
-        if elem.attrib['resolution'] == '20':
-            rows_20 = int(elem[0].text)
-            cols_20 = int(elem[1].text)
-        if elem.attrib['resolution'] == '60':
-            rows_60 = int(elem[0].text)
-            cols_60 = int(elem[1].text)
-    for elem in tree.iter(tag='Geoposition'):
-        if elem.attrib['resolution'] == '10':
-            ULX_10 = int(elem[0].text)
-            ULY_10 = int(elem[1].text)
-        if elem.attrib['resolution'] == '20':
-            ULX_20 = int(elem[0].text)
-            ULY_20 = int(elem[1].text)
-        if elem.attrib['resolution'] == '60':
-            ULX_60 = int(elem[0].text)
-            ULY_60 = int(elem[1].text)
-
-    # save to dictionary
-    metaDict.update({'sun_zenit': sunZen,
-                     'sun_azimuth': sunAz,
-                     'sensor_zenit': sensorZen,
-                     'sensor_azimuth': sensorAz,
-                     'projection': EPSG,
-                     'cloudCoverPercent': cldCoverPercent,
-                     'rows_10': rows_10,
-                     'cols_10': cols_10,
-                     'rows_20': rows_20,
-                     'cols_20': cols_20,
-                     'rows_60': rows_60,
-                     'cols_60': cols_60,
-                     'ULX_10': ULX_10,
-                     'ULY_10': ULY_10,
-                     'ULX_20': ULX_20,
-                     'ULY_20': ULY_20,
-                     'ULX_60': ULX_60,
-                     'ULY_60': ULY_60})
-    return metaDict
+    for path, elem in _iterElements(metadataTile):
+        tag = path[-1][0]
+        parent, parentElem = path[-2] if len(path) > 1 else (None, None)
+        grandParent = path[-3][0] if len(path) > 2 else None
+        if tag == "HORIZONTAL_CS_CODE":
+            metaDict['projection'] = elem.text
+        elif parent == "Size" and tag in ("NROWS", "NCOLS"):
+            name = 'rows_' if tag == "NROWS" else 'cols_'
+            metaDict[name + parentElem.attrib['resolution']] = int(elem.text)
+        elif parent == "Geoposition" and tag in ("ULX", "ULY"):
+            metaDict[tag + '_' + parentElem.attrib['resolution']] = int(float(elem.text))
+        # Get sun geometry - use the mean
+        elif parent == "Mean_Sun_Angle" and tag == "ZENITH_ANGLE":
+            metaDict['sun_zenit'] = float(elem.text)
+        elif parent == "Mean_Sun_Angle" and tag == "AZIMUTH_ANGLE":
+            metaDict['sun_azimuth'] = float(elem.text)
+        # Get sensor geometry - assume that all bands have the same angles
+        # (they differ slightly) and use the first one
+        elif (grandParent == "Mean_Viewing_Incidence_Angle_List" and
+              tag == "ZENITH_ANGLE" and 'sensor_zenit' not in metaDict):
+            metaDict['sensor_zenit'] = float(elem.text)
+        elif (grandParent == "Mean_Viewing_Incidence_Angle_List" and
+              tag == "AZIMUTH_ANGLE" and 'sensor_azimuth' not in metaDict):
+            metaDict['sensor_azimuth'] = float(elem.text)
+        elif tag == "CLOUDY_PIXEL_PERCENTAGE":
+            metaDict['cloudCoverPercent'] = float(elem.text)
+            # This comes after all the geometric information
+            break
+
+    return S2L1CMetadata(**metaDict)
+
+
+# Parse the XML file incrementally and yield (path, element) at the end of
+# every element. path is a list of (tag, element) from the root down to the
+# element, with namespaces removed. Elements are cleared once they have been
+# yielded, so large parts of the file (e.g. the angle grids) are never kept
+# in memory.
+def _iterElements(xmlFile):
+    path = []
+    with open(xmlFile, 'rb') as f:
+        for event, elem in ET.iterparse(f, events=("start", "end")):
+            if event == "start":
+                path.append((elem.tag.split('}')[-1], elem))
+            else:
+                yield path, elem
+                path.pop()
+                elem.clear()
+
+
+def _cacheFile(key, cacheDir):
+    name = hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + ".json"
+    return os.path.join(cacheDir, name)
+
+
+def _loadCachedMetadata(key, cacheDir):
+    if cacheDir is None:
+        return None
+    try:
+        with open(_cacheFile(key, cacheDir), 'r') as f:
+            metaDict = json.load(f)
+        metaDict['irradiance_values'] = tuple(metaDict['irradiance_values'])
+        metadata = S2L1CMetadata(**metaDict)
+        # Mark the entry as used
+        os.utime(_cacheFile(key, cacheDir), None)
+        return metadata
+    except (IOError, OSError, ValueError, TypeError):
+        return None
+
+
+def _saveCachedMetadata(key, metadata, cacheDir):
+    # A failure to write the cache should never stop the processing
+    if cacheDir is None:
+        return
+    try:
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+        with open(_cacheFile(key, cacheDir), 'w') as f:
+            json.dump(dict(metadata._asdict()), f)
+        evictCachedMetadata(cacheDir)
+    except (IOError, OSError):
+        pass
+
+
+# Remove the least recently used entries beyond maxEntries
+def evictCachedMetadata(cacheDir, maxEntries=None):
+    if maxEntries is None:
+        maxEntries = metadataCacheMaxEntries
+    entries = []
+    for name in os.listdir(cacheDir):
+        if name.endswith(".json"):
+            path = os.path.join(cacheDir, name)
+            entries.append((os.path.getmtime(path), path))
+    for lastUsed, path in sorted(entries)[:max(len(entries) - maxEntries, 0)]:
+        try:
+            os.remove(path)
+        except OSError:
+            # Removed by another process
+            pass
+
+
+# Read the coarse (5 km) sun angle grids from a granule MTD_TL.xml file.
+# Returns a dictionary with the zenith and azimuth grids as lists of rows of
+# floats (NaN where no value is given) and the grid spacing in metres.
+def readSunAngleGridS2L1C(metadataTile):
+    grids = {'zenith': [], 'azimuth': []}
+    for path, elem in _iterElements(metadataTile):
+        tags = [tag for tag, _ in path]
+        if "Sun_Angles_Grid" not in tags:
+            continue
+        tag = tags[-1]
+        if tag == "Sun_Angles_Grid":
+            # Nothing more is needed from this file
+            break
+        angle = 'zenith' if "Zenith" in tags else 'azimuth'
+        if tag == "VALUES":
+            grids[angle].append([float(value) for value in elem.text.split()])
+        elif tag == "ROW_STEP":
+            grids['row_step'] = float(elem.text)
+        elif tag == "COL_STEP":
+            grids['col_step'] = float(elem.text)
+    return grids
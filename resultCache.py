@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of corrected products.
+
+cachedAtmProcessingMain runs atmProcessingMain, unless an output made from
+the same input (raster paths, sizes and modification times), metadata values
+and output options is in the cache, in which case that output is copied (or
+hard linked) to the requested output file. The least recently used entries
+are removed when the cache grows beyond its disk budget. The cache is only
+used when options["resultCacheDir"] is given, e.g. resultCacheDir below.
+"""
+import os
+import glob
+import json
+import shutil
+import hashlib
+import uuid
+
+# Default directory of the cached outputs and their default disk budget in
+# bytes
+resultCacheDir = os.path.join(os.path.expanduser("~"), ".atmCorrection", "results")
+resultCacheBudgetDefault = 20 * 1024**3
+# Change when the processing changes its results, so that old entries are
+# no longer used
+resultCacheVersion = 1
+# Options that change the output files. Processing options such as workers or
+# the conversion kernel give identical results and are not part of the key.
+resultOptions = ["atmCorrMethod", "outputEncoding", "outputProfile", "perPixelSun",
+                 "nativeResolution", "dosSampleFraction", "dosTolerance"]
+# Name of the description of an entry, its modification time is the time the
+# entry was last used
+entryFileName = "entry.json"
+
+
+def cachedAtmProcessingMain(options):
+    from atmProcessing import atmProcessingMain
+
+    # Results in memory (no output file), previews and dry runs (which only
+    # return the processing plan) are not cached
+    outPath = options.get("reflectanceFile")
+    cacheDir = options.get("resultCacheDir")
+    if (not outPath or options.get("preview", False) or options.get("dryRun", False) or
+            cacheDir is None):
+        return atmProcessingMain(options)
+
+    budget = options.get("resultCacheBudget", resultCacheBudgetDefault)
+    # Hard link the cached files instead of copying them when they are on the
+    # same file system as the output. The output then shares its data with
+    # the cache, so it must not be modified in place.
+    link = options.get("resultCacheLink", False)
+    outFiles = outputFiles(options)
+    try:
+        entryDir = os.path.join(cacheDir, resultCacheKey(options))
+    except (IOError, OSError):
+        # The input is not a plain file (e.g. a GDAL connection string)
+        return atmProcessingMain(options)
+
+    if restoreCachedResult(entryDir, outFiles, link):
+        if options.get("progress") is not None:
+            options["progress"](100.0)
+        return _openOutputs(options, outFiles)
+
+    result = atmProcessingMain(options)
+    # The outputs are only complete once the datasets are closed
+    result = None
+    storeCachedResult(entryDir, outFiles, budget, link)
+    return _openOutputs(options, outFiles)
+
+
+# Key of the result of the options: a hash of the identity of the input
+# rasters, the metadata values and the options that change the output
+def resultCacheKey(options):
+    from read_satellite_metadata import readMetadataS2L1C
+
+    metadata = readMetadataS2L1C(options["metadataFile"])
+    if options.get("dnFile"):
+        inputFiles = [options["dnFile"]]
+    else:
+        imgDataDir = os.path.join(os.path.dirname(metadata.tile_metadata_file), "IMG_DATA")
+        inputFiles = sorted(glob.glob(os.path.join(imgDataDir, "*.jp2")))
+    inputs = [(os.path.abspath(path), os.path.getsize(path), os.path.getmtime(path))
+              for path in inputFiles]
+    metadataValues = dict(metadata._asdict())
+    # The tile metadata file is already identified by the metadata values
+    metadataValues.pop('tile_metadata_file')
+    outputOptions = dict((name, options.get(name)) for name in resultOptions)
+
+    key = json.dumps([resultCacheVersion, inputs, metadataValues, outputOptions],
+                     sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+# The files written for the options with their names in a cache entry,
+# including the .aux.xml files holding the histograms. The other files are
+# the primary outputs, which every entry must have.
+def outputFiles(options):
+    from atmProcessing import s2BandResolutions, resolutionFileName
+
+    outPath = options["reflectanceFile"]
+    if options.get("nativeResolution", False):
+        files = [(resolutionFileName(outPath, resolution),
+                  resolutionFileName("output.tif", resolution))
+                 for resolution in sorted(s2BandResolutions)]
+    else:
+        files = [(outPath, "output.tif")]
+    return files + [(path + ".aux.xml", name + ".aux.xml") for path, name in files]
+
+
+def _isPrimary(name):
+    return not name.endswith(".aux.xml")
+
+
+def _openOutputs(options, outFiles):
+    from osgeo import gdal
+    from atmProcessing import s2BandResolutions
+
+    if options.get("nativeResolution", False):
+        return dict((resolution, gdal.Open(outFiles[i][0]))
+                    for i, resolution in enumerate(sorted(s2BandResolutions)))
+    return gdal.Open(outFiles[0][0])
+
+
+# Copy (or hard link) the files of the entry to the output files and mark it
+# as used. Returns False if the entry does not exist or lacks a primary
+# output, the output files are then left untouched.
+def restoreCachedResult(entryDir, outFiles, link=False):
+    try:
+        with open(os.path.join(entryDir, entryFileName)) as f:
+            cachedNames = json.load(f)["files"]
+    except (IOError, OSError, ValueError, KeyError):
+        return False
+    for path, name in outFiles:
+        if _isPrimary(name) and (name not in cachedNames or
+                                 not os.path.isfile(os.path.join(entryDir, name))):
+            return False
+
+    for path, name in outFiles:
+        if os.path.exists(path):
+            os.remove(path)
+        if name not in cachedNames:
+            continue
+        _linkOrCopy(os.path.join(entryDir, name), path, link)
+    os.utime(os.path.join(entryDir, entryFileName), None)
+    return True
+
+
+# Copy (or hard link) the output files into a new entry and remove the least
+# recently used entries beyond the budget. Nothing is stored unless all the
+# primary outputs exist. A failure to write the cache should never stop the
+# processing.
+def storeCachedResult(entryDir, outFiles, budget, link=False):
+    if not all(os.path.isfile(path) for path, name in outFiles if _isPrimary(name)):
+        return
+    cacheDir = os.path.dirname(entryDir)
+    # The entry is written under a temporary name, so that a partly written
+    # entry is never used
+    tmpDir = os.path.join(cacheDir, "tmp_" + uuid.uuid4().hex)
+    try:
+        os.makedirs(tmpDir)
+        names = []
+        for path, name in outFiles:
+            if os.path.exists(path):
+                _linkOrCopy(path, os.path.join(tmpDir, name), link)
+                names.append(name)
+        with open(os.path.join(tmpDir, entryFileName), "w") as f:
+            json.dump({"files": names}, f)
+        if os.path.isdir(entryDir):
+            shutil.rmtree(entryDir)
+        os.rename(tmpDir, entryDir)
+    except (IOError, OSError):
+        shutil.rmtree(tmpDir, ignore_errors=True)
+        return
+    evictCachedResults(cacheDir, budget, keep=entryDir)
+
+
+def _linkOrCopy(source, destination, link):
+    if link:
+        try:
+            os.link(source, destination)
+            return
+        except (OSError, AttributeError):
+            # Other file system, or no hard links on this platform
+            pass
+    shutil.copyfile(source, destination)
+
+
+# Remove the least recently used entries until the cache fits in budget
+# bytes. The entry keep is never removed, even if it alone is too large.
+def evictCachedResults(cacheDir, budget, keep=None):
+    entries = []
+    for name in os.listdir(cacheDir):
+        entryDir = os.path.join(cacheDir, name)
+        entryFile = os.path.join(entryDir, entryFileName)
+        if not os.path.isfile(entryFile):
+            continue
+        size = sum(os.path.getsize(os.path.join(entryDir, fileName))
+                   for fileName in os.listdir(entryDir))
+        entries.append((os.path.getmtime(entryFile), size, entryDir))
+
+    total = sum(size for lastUsed, size, entryDir in entries)
+    for lastUsed, size, entryDir in sorted(entries):
+        if total <= budget:
+            break
+        if entryDir == keep:
+            continue
+        shutil.rmtree(entryDir, ignore_errors=True)
+        total -= size
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Consistency tests of the atmospheric correction on a small synthetic product.
+
+The threaded (workers) and pipelined (readers) variants must give exactly
+the same output as the serial run. ProductTestCase is shared with the tests of
+the other processing variants.
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+testDir = os.path.dirname(os.path.abspath(__file__))
+pluginDir = os.path.dirname(testDir)
+for folder in (pluginDir, os.path.join(pluginDir, "benchmarks")):
+    if folder not in sys.path:
+        sys.path.insert(0, folder)
+
+try:
+    from osgeo import gdal
+except ImportError:
+    gdal = None
+
+# Small windows so that every variant processes many of them
+windowPixels = 64 * 64
+
+
+# Runs the correction of a small synthetic product with different options
+@unittest.skipIf(gdal is None, "GDAL is not installed")
+class ProductTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        from syntheticProduct import createSyntheticProduct
+        import read_satellite_metadata
+        # The temporary product is not kept in the metadata cache
+        cls.metadataCacheDir = read_satellite_metadata.metadataCacheDir
+        read_satellite_metadata.metadataCacheDir = None
+        cls.workDir = tempfile.mkdtemp(prefix="atmCorrection_test_")
+        cls.metadataFile, cls.dnFile = createSyntheticProduct(cls.workDir, 300, 260, bands=4)
+
+    @classmethod
+    def tearDownClass(cls):
+        import read_satellite_metadata
+        read_satellite_metadata.metadataCacheDir = cls.metadataCacheDir
+        shutil.rmtree(cls.workDir, ignore_errors=True)
+
+    def process(self, method, **options):
+        from atmProcessing import atmProcessingMain
+        options.update({"dnFile": self.dnFile, "metadataFile": self.metadataFile,
+                        "atmCorrMethod": method, "windowPixels": windowPixels})
+        outImg = atmProcessingMain(options)
+        return outImg.ReadAsArray()
+
+    def assertSameOutput(self, method, **options):
+        expected = self.process(method)
+        result = self.process(method, **options)
+        self.assertEqual(result.dtype, expected.dtype)
+        # Bitwise identical, NaNs included
+        self.assertEqual(result.tobytes(), expected.tobytes())
+
+
+class ConsistencyTest(ProductTestCase):
+
+    def testWorkers(self):
+        for method in ["DOS", "TOA", "RAD"]:
+            self.assertSameOutput(method, workers=3)
+
+    def testReaders(self):
+        for method in ["DOS", "TOA", "RAD"]:
+            self.assertSameOutput(method, workers=2, readers=2)
+
+
+if __name__ == "__main__":
+    unittest.main()
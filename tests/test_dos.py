@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the dark object offsets against the per-band np.histogram search
+they replaced. Only the tests reading a synthetic product need GDAL.
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+testDir = os.path.dirname(os.path.abspath(__file__))
+pluginDir = os.path.dirname(testDir)
+for folder in (pluginDir, os.path.join(pluginDir, "benchmarks")):
+    if folder not in sys.path:
+        sys.path.insert(0, folder)
+
+try:
+    from osgeo import gdal
+except ImportError:
+    gdal = None
+
+from processingCore import dnCounts, dosOffsets
+
+
+# DOS offset of the original implementation: the first DN where the histogram
+# of DNs 1 to 2048 rises by more than a millionth of the valid pixels of the
+# first band
+def histogramOffset(hist, numElements):
+    for i in range(1, len(hist)):
+        if hist[i] - hist[i-1] > (numElements-numElements*0.999999):
+            return i-1
+    return 0
+
+
+def histogramOffsets(bands):
+    numElements = np.size(bands[0][bands[0] != 0])
+    offsets = []
+    for data in bands:
+        hist, edges = np.histogram(data, bins=2048, range=(1, 2048), density=False)
+        offsets.append(histogramOffset(hist, numElements))
+    return offsets
+
+
+class DosOffsetsTest(unittest.TestCase):
+
+    def testDnCounts(self):
+        data = np.random.RandomState(0).randint(0, 3000, (50, 40)).astype(np.uint16)
+        counts = dnCounts(data)
+        self.assertEqual(counts.shape, (65536,))
+        np.testing.assert_array_equal(counts[:3000], np.bincount(data.ravel(), minlength=3000))
+        # DNs 1 to 2048 are the bins of the original histogram
+        hist, edges = np.histogram(data, bins=2048, range=(1, 2048))
+        np.testing.assert_array_equal(counts[1:2049], hist)
+        # Other types are clipped to 16-bit DNs
+        counts = dnCounts(np.array([-5, 0, 7.0, 70000]))
+        self.assertEqual((counts[0], counts[7], counts[65535]), (2, 1, 1))
+
+    def testImages(self):
+        random = np.random.RandomState(1)
+        for darkest in [1, 150, 900, 2500]:
+            bands = [random.randint(darkest, darkest + 2000, (200, 300)) for i in range(4)]
+            bands[0][:20] = 0
+            numElements = np.count_nonzero(bands[0])
+            lowHist = np.array([dnCounts(data)[1:2049] for data in bands])
+            offsets = dosOffsets(lowHist, numElements)
+            self.assertEqual(list(offsets), histogramOffsets(bands))
+
+    def testThreshold(self):
+        # Rises at or below a millionth of the valid pixels are ignored
+        random = np.random.RandomState(2)
+        lowHist = random.poisson(random.randint(1, 2000, (6, 1)), (6, 2048))
+        for numElements in [1000, 10 ** 8, 10 ** 9, 10 ** 12]:
+            expected = [histogramOffset(hist, numElements) for hist in lowHist]
+            self.assertEqual(list(dosOffsets(lowHist, numElements)), expected)
+
+    def testNoRise(self):
+        lowHist = np.zeros((2, 2048), dtype=np.int64)
+        lowHist[1, :] = 5
+        self.assertEqual(list(dosOffsets(lowHist, 100)), [0, 0])
+
+    def testResamples(self):
+        # The bootstrap resamples of the approximate DOS are computed in one go
+        random = np.random.RandomState(3)
+        lowHists = random.poisson(random.randint(1, 50, (5, 3, 1)), (5, 3, 2048))
+        numElements = random.randint(10 ** 6, 10 ** 8, 5)
+        expected = [[histogramOffset(hist, numElements[i]) for hist in lowHists[i]]
+                    for i in range(5)]
+        self.assertEqual(dosOffsets(lowHists, numElements).tolist(), expected)
+
+
+@unittest.skipIf(gdal is None, "GDAL is not installed")
+class DarkObjectTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        from syntheticProduct import createSyntheticProduct
+        import read_satellite_metadata
+        cls.metadataCacheDir = read_satellite_metadata.metadataCacheDir
+        read_satellite_metadata.metadataCacheDir = None
+        cls.workDir = tempfile.mkdtemp(prefix="atmCorrection_test_")
+        cls.metadataFile, cls.dnFile = createSyntheticProduct(cls.workDir, 300, 260, bands=4)
+
+    @classmethod
+    def tearDownClass(cls):
+        import read_satellite_metadata
+        read_satellite_metadata.metadataCacheDir = cls.metadataCacheDir
+        shutil.rmtree(cls.workDir, ignore_errors=True)
+
+    def testDarkObjectSubstraction(self):
+        from atmProcessing import darkObjectSubstraction
+        inImg = gdal.Open(self.dnFile)
+        expected = histogramOffsets([inImg.GetRasterBand(band).ReadAsArray()
+                                     for band in range(1, inImg.RasterCount+1)])
+        self.assertEqual(darkObjectSubstraction(inImg), expected)
+        self.assertEqual(darkObjectSubstraction(inImg, workers=3), expected)
+
+    def testApproximate(self):
+        from syntheticProduct import createSyntheticProduct
+        from atmProcessing import approximateDarkObjectSubstraction, \
+            darkObjectSubstraction, dosOffsetsFor
+        # 64 blocks of 256 x 256 pixels
+        metadataFile, dnFile = createSyntheticProduct(self.workDir, 2048, 2048, bands=4,
+                                                      name="TILED", tiled=True)
+        inImg = gdal.Open(dnFile)
+        expected = darkObjectSubstraction(inImg)
+        offsets, deviations = approximateDarkObjectSubstraction(inImg, 0.25)
+        self.assertEqual(len(deviations), 4)
+        for offset, deviation, exact in zip(offsets, deviations, expected):
+            self.assertLessEqual(abs(offset - exact), 1)
+            self.assertLess(deviation, 1.0)
+        self.assertEqual(dosOffsetsFor(inImg, 0.25)[:2], (offsets, deviations))
+        # Deviations above the tolerance fall back to the whole image
+        offsets, deviations, hist = dosOffsetsFor(inImg, 0.25, tolerance=0.0)
+        self.assertEqual((offsets, deviations), (expected, None))
+        self.assertEqual(hist.shape, (4, 65536))
+
+        # Sampling more than half of the blocks, or a small image, saves nothing
+        self.assertEqual(approximateDarkObjectSubstraction(inImg, 0.6), (None, None))
+        small = gdal.Open(self.dnFile)
+        self.assertEqual(approximateDarkObjectSubstraction(small, 0.1), (None, None))
+
+
+if __name__ == "__main__":
+    unittest.main()
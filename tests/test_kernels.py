@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the conversion kernels and of the lookup tables of all 16-bit DNs
+that replace them with kernel "lut". Only the tests reading a synthetic
+product need GDAL.
+"""
+import os
+import sys
+import unittest
+
+import numpy as np
+
+testDir = os.path.dirname(os.path.abspath(__file__))
+if testDir not in sys.path:
+    sys.path.insert(0, testDir)
+
+from test_consistency import ProductTestCase
+from processingCore import reflectanceKernel, radianceKernel, lookupKernel, \
+    reflectanceTable, radianceTable
+
+allDNs = np.arange(65536, dtype=np.uint16)
+
+
+class KernelTest(unittest.TestCase):
+
+    def testReflectance(self):
+        for dos in [0, 1, 137, 2047]:
+            out = reflectanceKernel(allDNs, dos, 10000.0, np.empty(65536, dtype=np.float32))
+            expected = np.maximum(allDNs.astype(np.float64) - dos, 0) / 10000.0
+            np.testing.assert_allclose(out, expected, rtol=1e-6)
+            self.assertEqual(out[:dos+1].max(), 0.0)
+
+    def testRadiance(self):
+        scale = 1913.57 * 0.971 * np.cos(np.radians(36.65)) / (np.pi * 10000.0)
+        out = radianceKernel(allDNs, scale, np.empty(65536, dtype=np.float32))
+        np.testing.assert_allclose(out, allDNs * scale, rtol=1e-6)
+
+    def testTables(self):
+        # The tables are computed with the kernels, so the lookup is exact
+        table = reflectanceTable(137, 10000.0)
+        out = lookupKernel(allDNs, table, np.empty(65536, dtype=np.float32))
+        expected = reflectanceKernel(allDNs, 137, 10000.0, np.empty(65536, dtype=np.float32))
+        self.assertEqual(out.tobytes(), expected.tobytes())
+
+        table = radianceTable(0.05)
+        out = lookupKernel(allDNs, table, np.empty(65536, dtype=np.float32))
+        expected = radianceKernel(allDNs, 0.05, np.empty(65536, dtype=np.float32))
+        self.assertEqual(out.tobytes(), expected.tobytes())
+
+    def testWindows(self):
+        # 8 and 16 bit windows are looked up without copies
+        table = reflectanceTable(20, 10000.0)
+        for dtype in [np.uint8, np.uint16]:
+            data = np.random.RandomState(0).randint(0, np.iinfo(dtype).max, (30, 40))
+            data = data.astype(dtype)
+            out = lookupKernel(data, table, np.empty(data.shape, dtype=np.float32))
+            expected = reflectanceKernel(data, 20, 10000.0,
+                                         np.empty(data.shape, dtype=np.float32))
+            self.assertEqual(out.tobytes(), expected.tobytes())
+
+
+class LookupKernelTest(ProductTestCase):
+
+    def testLookupKernel(self):
+        for method in ["DOS", "TOA", "RAD"]:
+            self.assertSameOutput(method, kernel="lut")
+            self.assertSameOutput(method, kernel="lut", workers=2, readers=2)
+
+
+if __name__ == "__main__":
+    unittest.main()
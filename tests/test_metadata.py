@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the Sentinel-2 L1C metadata reader and its cache on a synthetic
+product. They run without GDAL.
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+testDir = os.path.dirname(os.path.abspath(__file__))
+pluginDir = os.path.dirname(testDir)
+for folder in (pluginDir, os.path.join(pluginDir, "benchmarks")):
+    if folder not in sys.path:
+        sys.path.insert(0, folder)
+
+import read_satellite_metadata
+from read_satellite_metadata import readMetadataS2L1C, readSunAngleGridS2L1C, \
+    evictCachedMetadata
+from syntheticProduct import createSyntheticMetadata, solarIrradiance, angleGridSize, \
+    tileULX, tileULY
+
+
+class MetadataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp(prefix="atmCorrection_test_")
+        self.cacheDir = os.path.join(self.workDir, "cache")
+        self.metadataCacheDir = read_satellite_metadata.metadataCacheDir
+        read_satellite_metadata.metadataCacheDir = None
+
+    def tearDown(self):
+        read_satellite_metadata.metadataCacheDir = self.metadataCacheDir
+        shutil.rmtree(self.workDir, ignore_errors=True)
+
+    def testParse(self):
+        metadataFile = createSyntheticMetadata(self.workDir, 1000, 600, bands=13)
+        metadata = readMetadataS2L1C(metadataFile)
+        self.assertEqual(metadata.product_name, "S2A_MSIL1C_SYNTHETIC.SAFE")
+        self.assertEqual(metadata.product_start, "2017-06-01T10:20:21.026Z")
+        self.assertEqual(metadata.processing_level, "Level-1C")
+        self.assertEqual(metadata.spacecraft, "Sentinel-2A")
+        self.assertEqual(metadata.orbit_direction, "DESCENDING")
+        self.assertEqual(metadata.quantification_value, 10000.0)
+        self.assertEqual(metadata.reflection_conversion, 0.971)
+        self.assertEqual(metadata.irradiance_values, tuple(solarIrradiance))
+        self.assertTrue(metadata.tile_metadata_file.endswith("MTD_TL.xml"))
+        self.assertEqual(metadata.projection, "EPSG:32632")
+        self.assertEqual(metadata.cloudCoverPercent, 10.0)
+        # Mean of the synthetic zenith grid
+        meanZenith = 35.0 + 0.15 * (angleGridSize - 1) / 2.0
+        self.assertAlmostEqual(metadata.sun_zenit, meanZenith, places=5)
+        self.assertEqual(metadata.sun_azimuth, 150.0)
+        self.assertEqual((metadata.sensor_zenit, metadata.sensor_azimuth), (5.0, 100.0))
+        self.assertEqual((metadata.rows_10, metadata.cols_10), (1000, 600))
+        self.assertEqual((metadata.rows_20, metadata.cols_20), (500, 300))
+        self.assertEqual((metadata.rows_60, metadata.cols_60), (166, 100))
+        self.assertEqual((metadata.ULX_60, metadata.ULY_60), (tileULX, tileULY))
+
+    def testSunAngleGrid(self):
+        metadataFile = createSyntheticMetadata(self.workDir, 100, 100, bands=4)
+        grids = readSunAngleGridS2L1C(readMetadataS2L1C(metadataFile).tile_metadata_file)
+        self.assertEqual(len(grids['zenith']), angleGridSize)
+        self.assertEqual(len(grids['azimuth'][0]), angleGridSize)
+        self.assertAlmostEqual(grids['zenith'][1][2], 35.2)
+        self.assertEqual((grids['col_step'], grids['row_step']), (5000.0, 5000.0))
+
+    def testCache(self):
+        read_satellite_metadata.metadataCacheDir = self.cacheDir
+        metadataFile = createSyntheticMetadata(self.workDir, 100, 100, bands=4)
+        metadata = readMetadataS2L1C(metadataFile)
+        self.assertEqual(len(os.listdir(self.cacheDir)), 1)
+        # Read again from the disk cache by a new process
+        read_satellite_metadata._metadataMemoryCache.clear()
+        self.assertEqual(readMetadataS2L1C(metadataFile), metadata)
+
+        # A changed file is parsed again
+        stat = os.stat(metadataFile)
+        os.utime(metadataFile, (stat.st_atime, stat.st_mtime + 10))
+        readMetadataS2L1C(metadataFile)
+        self.assertEqual(len(os.listdir(self.cacheDir)), 2)
+
+        # No disk cache
+        read_satellite_metadata.metadataCacheDir = None
+        otherFile = createSyntheticMetadata(self.workDir, 100, 100, bands=4, name="OTHER")
+        readMetadataS2L1C(otherFile)
+        self.assertEqual(len(os.listdir(self.cacheDir)), 2)
+        # Or another one given by the caller
+        otherDir = os.path.join(self.workDir, "other")
+        read_satellite_metadata._metadataMemoryCache.clear()
+        readMetadataS2L1C(otherFile, cacheDir=otherDir)
+        self.assertEqual(len(os.listdir(otherDir)), 1)
+
+    def testEviction(self):
+        os.makedirs(self.cacheDir)
+        for i in range(5):
+            path = os.path.join(self.cacheDir, "%d.json" % i)
+            with open(path, "w") as f:
+                f.write("{}")
+            lastUsed = time.time() - 100 + i
+            os.utime(path, (lastUsed, lastUsed))
+        evictCachedMetadata(self.cacheDir, 2)
+        self.assertEqual(sorted(os.listdir(self.cacheDir)), ["3.json", "4.json"])
+
+
+if __name__ == "__main__":
+    unittest.main()
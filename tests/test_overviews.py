@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the overviews streamed into COG outputs. They run without GDAL.
+"""
+import os
+import sys
+import unittest
+
+import numpy as np
+
+testDir = os.path.dirname(os.path.abspath(__file__))
+pluginDir = os.path.dirname(testDir)
+if pluginDir not in sys.path:
+    sys.path.insert(0, pluginDir)
+
+from processingCore import halveWindow, overviewFactors
+
+
+class OverviewTest(unittest.TestCase):
+
+    def testOverviewFactors(self):
+        # Halving until the smallest overview fits in one 256 pixel tile
+        self.assertEqual(overviewFactors(10980, 10980), [2, 4, 8, 16, 32, 64])
+        self.assertEqual(overviewFactors(300, 100), [2])
+        self.assertEqual(overviewFactors(256, 256), [])
+
+    def testHalveWindow(self):
+        data = np.arange(2 * 4 * 6, dtype=np.float32).reshape(2, 4, 6)
+        means, counts = halveWindow(data, np.ones((4, 6), dtype=np.float32))
+        expected = data.reshape(2, 2, 2, 3, 2).mean(axis=(2, 4))
+        np.testing.assert_allclose(means, expected)
+        np.testing.assert_array_equal(counts, np.full((2, 3), 4))
+
+    def testOddSize(self):
+        # The last row and column are partial blocks
+        data = np.arange(3 * 5, dtype=np.float32).reshape(1, 3, 5)
+        means, counts = halveWindow(data, np.ones((3, 5), dtype=np.float32))
+        np.testing.assert_array_equal(counts, [[4, 4, 2], [2, 2, 1]])
+        self.assertAlmostEqual(means[0, 0, 0], data[0, :2, :2].mean())
+        self.assertAlmostEqual(means[0, 0, 2], data[0, :2, 4].mean())
+        self.assertAlmostEqual(means[0, 1, 2], data[0, 2, 4])
+
+    def testRepeatedHalving(self):
+        # Each level is the mean of all the pixels behind it, also when the
+        # blocks of the previous level were partial
+        data = np.random.RandomState(0).rand(1, 7, 9).astype(np.float32)
+        means, counts = halveWindow(data, np.ones((7, 9), dtype=np.float32))
+        means, counts = halveWindow(means, counts)
+        self.assertEqual(means.shape, (1, 2, 3))
+        self.assertAlmostEqual(means[0, 0, 0], data[0, :4, :4].mean(), places=5)
+        self.assertAlmostEqual(means[0, 1, 2], data[0, 4:, 8:].mean(), places=5)
+        self.assertEqual(counts.sum(), 7 * 9)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the processing windows and the memory planner on the metadata of a
+synthetic product. They run without GDAL.
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+testDir = os.path.dirname(os.path.abspath(__file__))
+pluginDir = os.path.dirname(testDir)
+for folder in (pluginDir, os.path.join(pluginDir, "benchmarks")):
+    if folder not in sys.path:
+        sys.path.insert(0, folder)
+
+import processingPlan
+import read_satellite_metadata
+from processingCore import windowStep
+from syntheticProduct import createSyntheticMetadata
+
+gigabyte = 1024 ** 3
+
+
+class WindowStepTest(unittest.TestCase):
+
+    def testStrips(self):
+        # Strips span the whole width and are stacked vertically
+        self.assertEqual(windowStep(1000, 5000, [1000, 1], 100000), (1000, 100))
+        self.assertEqual(windowStep(1000, 50, [1000, 1], 100000), (1000, 50))
+
+    def testTiles(self):
+        # Tiles are processed one at a time, tiny ones grown vertically
+        self.assertEqual(windowStep(10980, 10980, [1024, 1024], 1024 * 1024), (1024, 1024))
+        self.assertEqual(windowStep(10980, 10980, [1024, 1024], 1000), (1024, 1024))
+        self.assertEqual(windowStep(10980, 10980, [256, 256], 1024 * 1024), (256, 4096))
+
+    def testOutputBlocks(self):
+        # Whole output blocks, and whole blocks of the largest overview
+        self.assertEqual(windowStep(1000, 5000, [1000, 1], 100000, outBlockY=256),
+                         (1000, 256))
+        self.assertEqual(windowStep(1000, 5000, [1000, 1], 100000, overviewCount=3),
+                         (1000, 104))
+
+
+class ProcessingPlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp(prefix="atmCorrection_test_")
+        self.metadataCacheDir = read_satellite_metadata.metadataCacheDir
+        read_satellite_metadata.metadataCacheDir = None
+        self.metadataFile = createSyntheticMetadata(self.workDir, 10980, 10980)
+
+    def tearDown(self):
+        read_satellite_metadata.metadataCacheDir = self.metadataCacheDir
+        shutil.rmtree(self.workDir, ignore_errors=True)
+
+    def options(self, **options):
+        options.update({"metadataFile": self.metadataFile})
+        options.setdefault("atmCorrMethod", "DOS")
+        options.setdefault("reflectanceFile", os.path.join(self.workDir, "out.tif"))
+        return options
+
+    def testDescribeInputs(self):
+        raster, = processingPlan.describeInputs(self.options())
+        self.assertEqual((raster['cols'], raster['rows'], raster['bands']), (10980, 10980, 13))
+        self.assertEqual(raster['outBands'], 13)
+        # Radiance is only computed for the visible and NIR bands
+        raster, = processingPlan.describeInputs(self.options(atmCorrMethod="RAD"))
+        self.assertEqual(raster['outBands'], 9)
+
+        rasters = processingPlan.describeInputs(self.options(nativeResolution=True))
+        self.assertEqual([(raster['cols'], raster['bands']) for raster in rasters],
+                         [(10980, 4), (5490, 6), (1830, 3)])
+
+        raster, = processingPlan.describeInputs(self.options(preview=True, previewSize=500))
+        self.assertEqual((raster['cols'], raster['rows']), (500, 500))
+
+    def testBytes(self):
+        pixels = 10980 * 10980 * 13
+        plan = processingPlan.planProcessing(self.options(), 100 * gigabyte)
+        # Histogram and conversion passes, float32 output
+        self.assertEqual(plan['bytesRead'], pixels * 2 * 2)
+        self.assertEqual(plan['bytesWritten'], pixels * 4)
+        plan = processingPlan.planProcessing(
+            self.options(atmCorrMethod="TOA", outputEncoding="UInt16"), 100 * gigabyte)
+        self.assertEqual(plan['bytesRead'], pixels * 2)
+        self.assertEqual(plan['bytesWritten'], pixels * 2)
+
+    def testSampledDOS(self):
+        raster, = processingPlan.describeInputs(self.options())
+        # At least 16 of the 121 JP2 blocks
+        self.assertAlmostEqual(processingPlan.sampledFraction(raster, 0.01), 16 / 121.0)
+        self.assertAlmostEqual(processingPlan.sampledFraction(raster, 0.2), 24 / 121.0)
+        # More than half of the blocks: the whole image is read
+        self.assertEqual(processingPlan.sampledFraction(raster, 0.6), 1.0)
+
+    def testBudget(self):
+        options = self.options(workers=8, readers=4)
+        plan = processingPlan.planProcessing(options, 100 * gigabyte)
+        self.assertTrue(plan['fits'])
+        self.assertEqual((plan['workers'], plan['readers']), (8, 4))
+        self.assertEqual(plan['gdalCacheMax'], processingPlan.gdalCachePreferred)
+
+        budget = gigabyte
+        plan = processingPlan.planProcessing(options, budget)
+        self.assertTrue(plan['fits'])
+        self.assertLessEqual(plan['peakMemory'], budget)
+        self.assertLess(plan['workers'] + plan['readers'], 12)
+
+        plan = processingPlan.planProcessing(options, 100 * 1024 ** 2)
+        self.assertFalse(plan['fits'])
+        self.assertEqual((plan['workers'], plan['readers']), (1, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
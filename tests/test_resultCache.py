@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the result cache: the key, storing and restoring entries and their
+eviction. They only use the file system and run without GDAL.
+"""
+import os
+import sys
+import json
+import time
+import types
+import shutil
+import tempfile
+import unittest
+
+testDir = os.path.dirname(os.path.abspath(__file__))
+pluginDir = os.path.dirname(testDir)
+for folder in (pluginDir, os.path.join(pluginDir, "benchmarks")):
+    if folder not in sys.path:
+        sys.path.insert(0, folder)
+
+import resultCache
+import read_satellite_metadata
+from syntheticProduct import createSyntheticMetadata
+
+
+def writeFile(path, content):
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def readFile(path):
+    with open(path) as f:
+        return f.read()
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp(prefix="atmCorrection_test_")
+        self.cacheDir = os.path.join(self.workDir, "cache")
+        os.makedirs(self.cacheDir)
+        self.outPath = os.path.join(self.workDir, "out.tif")
+        self.outFiles = [(self.outPath, "output.tif"),
+                         (self.outPath + ".aux.xml", "output.tif.aux.xml")]
+        self.metadataCacheDir = read_satellite_metadata.metadataCacheDir
+        read_satellite_metadata.metadataCacheDir = None
+
+    def tearDown(self):
+        read_satellite_metadata.metadataCacheDir = self.metadataCacheDir
+        shutil.rmtree(self.workDir, ignore_errors=True)
+
+    def entryDir(self, name="entry"):
+        return os.path.join(self.cacheDir, name)
+
+    def testKey(self):
+        metadataFile = createSyntheticMetadata(self.workDir, 100, 100, bands=4)
+        dnFile = os.path.join(self.workDir, "dn.tif")
+        writeFile(dnFile, "dn")
+        options = {"metadataFile": metadataFile, "dnFile": dnFile, "atmCorrMethod": "DOS"}
+        key = resultCache.resultCacheKey(options)
+
+        # Processing options do not change the output
+        self.assertEqual(resultCache.resultCacheKey(dict(options, workers=4, kernel="lut")),
+                         key)
+        self.assertNotEqual(resultCache.resultCacheKey(dict(options, atmCorrMethod="TOA")),
+                            key)
+        self.assertNotEqual(
+            resultCache.resultCacheKey(dict(options, outputEncoding="UInt16")), key)
+        # A changed input raster
+        stat = os.stat(dnFile)
+        os.utime(dnFile, (stat.st_atime, stat.st_mtime + 10))
+        self.assertNotEqual(resultCache.resultCacheKey(options), key)
+
+    def testStoreRestore(self):
+        writeFile(self.outPath, "result")
+        writeFile(self.outPath + ".aux.xml", "histograms")
+        resultCache.storeCachedResult(self.entryDir(), self.outFiles, 10**9)
+        os.remove(self.outPath)
+        writeFile(self.outPath + ".aux.xml", "stale")
+
+        self.assertTrue(resultCache.restoreCachedResult(self.entryDir(), self.outFiles))
+        self.assertEqual(readFile(self.outPath), "result")
+        self.assertEqual(readFile(self.outPath + ".aux.xml"), "histograms")
+
+    def testRestoreMissing(self):
+        writeFile(self.outPath, "existing")
+        self.assertFalse(resultCache.restoreCachedResult(self.entryDir(), self.outFiles))
+        self.assertEqual(readFile(self.outPath), "existing")
+
+    def testNoEntryWithoutOutput(self):
+        # Only the .aux.xml exists, e.g. the run wrote no output
+        writeFile(self.outPath + ".aux.xml", "histograms")
+        resultCache.storeCachedResult(self.entryDir(), self.outFiles, 10**9)
+        self.assertEqual(os.listdir(self.cacheDir), [])
+
+    def testIncompleteEntryIsMiss(self):
+        # An entry without the primary output, as stored by earlier versions
+        os.makedirs(self.entryDir())
+        writeFile(os.path.join(self.entryDir(), resultCache.entryFileName),
+                  json.dumps({"files": []}))
+        writeFile(self.outPath, "existing")
+        self.assertFalse(resultCache.restoreCachedResult(self.entryDir(), self.outFiles))
+        self.assertEqual(readFile(self.outPath), "existing")
+
+    def testEviction(self):
+        writeFile(self.outPath, "x" * 100)
+        for i, name in enumerate(["a", "b", "c"]):
+            resultCache.storeCachedResult(self.entryDir(name), self.outFiles, 10**9)
+            # Last used a, b, c in this order
+            lastUsed = time.time() - 100 + i
+            os.utime(os.path.join(self.entryDir(name), resultCache.entryFileName),
+                     (lastUsed, lastUsed))
+        # Using a makes b the least recently used
+        self.assertTrue(resultCache.restoreCachedResult(self.entryDir("a"), self.outFiles))
+
+        resultCache.evictCachedResults(self.cacheDir, 250)
+        self.assertEqual(sorted(os.listdir(self.cacheDir)), ["a", "c"])
+        # The kept entry stays even when it alone is over the budget
+        resultCache.evictCachedResults(self.cacheDir, 0, keep=self.entryDir("c"))
+        self.assertEqual(os.listdir(self.cacheDir), ["c"])
+
+    def testDryRunNotCached(self):
+        calls = []
+
+        def atmProcessingMain(options):
+            calls.append(options)
+            return {"fits": True}
+
+        # Stand-in for the processing, which needs GDAL
+        stub = types.ModuleType("atmProcessing")
+        stub.atmProcessingMain = atmProcessingMain
+        module = sys.modules.get("atmProcessing")
+        sys.modules["atmProcessing"] = stub
+        try:
+            result = resultCache.cachedAtmProcessingMain(
+                {"reflectanceFile": self.outPath, "dryRun": True,
+                 "resultCacheDir": self.cacheDir})
+        finally:
+            if module is None:
+                del sys.modules["atmProcessing"]
+            else:
+                sys.modules["atmProcessing"] = module
+        self.assertEqual(result, {"fits": True})
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(os.listdir(self.cacheDir), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the per-pixel sun zenith angle used by the radiance with
+perPixelSun. They run without GDAL.
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+testDir = os.path.dirname(os.path.abspath(__file__))
+pluginDir = os.path.dirname(testDir)
+for folder in (pluginDir, os.path.join(pluginDir, "benchmarks")):
+    if folder not in sys.path:
+        sys.path.insert(0, folder)
+
+import read_satellite_metadata
+from processingCore import cosSunZenithGrid, cosSunZenithWindow
+from syntheticProduct import createSyntheticMetadata, angleGridSize, angleGridStep, \
+    tileULX, tileULY
+
+# 10 m pixels from the upper left corner of the tile
+geotransform = (tileULX, 10, 0, tileULY, 0, -10)
+
+
+class SunAngleTest(unittest.TestCase):
+
+    def testPlaneIsExact(self):
+        # The bilinear interpolation of a plane is the plane itself
+        rows, cols = np.mgrid[0:5, 0:4]
+        grid = (0.5 + 0.01 * rows + 0.02 * cols).astype(np.float32)
+        cosZenithGrid = (grid, tileULX, tileULY, 5000.0, 5000.0)
+        window = (100, 200, 1200, 900)
+        cosZenith = cosSunZenithWindow(cosZenithGrid, geotransform, window)
+        self.assertEqual(cosZenith.shape, (900, 1200))
+
+        x = (window[0] + np.arange(window[2]) + 0.5) * 10 / 5000.0
+        y = (window[1] + np.arange(window[3]) + 0.5) * 10 / 5000.0
+        expected = 0.5 + 0.01 * y[:, np.newaxis] + 0.02 * x[np.newaxis, :]
+        np.testing.assert_allclose(cosZenith, expected, rtol=1e-6)
+
+    def testOutsideGrid(self):
+        # Pixels beyond the last grid point take the value of the edge
+        grid = np.arange(9, dtype=np.float32).reshape(3, 3)
+        cosZenithGrid = (grid, tileULX, tileULY, 5000.0, 5000.0)
+        cosZenith = cosSunZenithWindow(cosZenithGrid, geotransform, (1000, 1000, 200, 200))
+        np.testing.assert_allclose(cosZenith, grid[-1, -1])
+
+    def testWindowsMatch(self):
+        # A window gives the same values as the same pixels of a larger one
+        grid = np.random.RandomState(0).rand(6, 6).astype(np.float32)
+        cosZenithGrid = (grid, tileULX, tileULY, 5000.0, 5000.0)
+        large = cosSunZenithWindow(cosZenithGrid, geotransform, (0, 0, 2000, 1500))
+        small = cosSunZenithWindow(cosZenithGrid, geotransform, (700, 300, 500, 600))
+        np.testing.assert_allclose(small, large[300:900, 700:1200], rtol=1e-6)
+
+
+class SunAngleGridTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp(prefix="atmCorrection_test_")
+        self.metadataCacheDir = read_satellite_metadata.metadataCacheDir
+        read_satellite_metadata.metadataCacheDir = None
+
+    def tearDown(self):
+        read_satellite_metadata.metadataCacheDir = self.metadataCacheDir
+        shutil.rmtree(self.workDir, ignore_errors=True)
+
+    def testGridFromMetadata(self):
+        metadataFile = createSyntheticMetadata(self.workDir, 100, 100, bands=4)
+        metadata = read_satellite_metadata.readMetadataS2L1C(metadataFile)
+        grid, ulx, uly, colStep, rowStep = cosSunZenithGrid(metadata)
+        self.assertEqual(grid.shape, (angleGridSize, angleGridSize))
+        self.assertEqual((ulx, uly, colStep, rowStep),
+                         (tileULX, tileULY, angleGridStep, angleGridStep))
+        # The zenith of the synthetic grid increases by 0.1 degrees per row
+        # and 0.05 per column from 35 degrees
+        self.assertAlmostEqual(grid[0, 0], np.cos(np.radians(35.0)), places=6)
+        self.assertAlmostEqual(grid[2, 4], np.cos(np.radians(35.4)), places=6)
+
+
+if __name__ == "__main__":
+    unittest.main()